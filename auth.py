@@ -1,18 +1,129 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Deque, Dict, Iterable, List, Optional
+from fastapi import HTTPException, status
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+from sqlalchemy import delete, event, inspect, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session, object_session
+import asyncio
+import logging
 import os
+import threading
+import time
+import uuid
 from dotenv import load_dotenv
 
+from cache import TTLCache
+from database import SessionLocal, upsert
+from models import TokenRevocation, User
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Security
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+# How often each worker reloads the user revocations made by the others
+REVOCATION_SYNC_SECONDS = float(os.getenv("REVOCATION_SYNC_SECONDS", "5"))
+
+# Authenticated-user cache (keyed by token subject)
+USER_CACHE_TTL_SECONDS = int(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "1024"))
+
+user_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Hashes with fewer rounds are upgraded on the user's next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+# Password hashing pool. bcrypt releases the GIL, so threads hash in
+# parallel without blocking the event loop.
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 2)))
+# Requests queued or running beyond this are rejected with a 503
+HASH_MAX_PENDING = int(os.getenv("HASH_MAX_PENDING", "64"))
+
+class HashPool:
+    def __init__(self, workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="password-hash")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def submit(self, fn: Callable, *args) -> Future:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many concurrent sign-ins, please retry",
+                    headers={"Retry-After": "1"},
+                )
+            self.pending += 1
+        return self._executor.submit(self._run, time.perf_counter(), fn, *args)
+
+    def _run(self, queued_at: float, fn: Callable, *args):
+        waited = time.perf_counter() - queued_at
+        with self._lock:
+            self.running += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.pending -= 1
+                self.completed += 1
+
+    async def run(self, fn: Callable, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def map(self, fn: Callable, items: Iterable) -> List:
+        """fn(item) for every item, in order. Blocks the calling thread.
+
+        For bulk work: never rejected, and at most one item per worker is
+        queued at a time so sign-ins are not stuck behind the whole batch.
+        """
+        window = self._executor._max_workers
+        in_flight: Deque[Future] = deque()
+        results = []
+        for item in items:
+            if len(in_flight) >= window:
+                results.append(in_flight.popleft().result())
+            with self._lock:
+                self.pending += 1
+            in_flight.append(self._executor.submit(self._run, time.perf_counter(), fn, item))
+        while in_flight:
+            results.append(in_flight.popleft().result())
+        return results
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self._executor._max_workers,
+                "max_pending": self.max_pending,
+                "queued": self.pending - self.running,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "wait_seconds_total": round(self.wait_seconds_total, 6),
+                "wait_seconds_max": round(self.wait_seconds_max, 6),
+            }
+
+hash_pool = HashPool()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -20,12 +131,327 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+async def verify_and_update_password_async(plain_password, hashed_password):
+    """(valid, new_hash): new_hash is set when the stored hash is outdated."""
+    return await hash_pool.run(pwd_context.verify_and_update, plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "iat": time.time()})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt 
\ No newline at end of file
+    return encoded_jwt
+
+# Tokens
+
+@dataclass
+class TokenUser:
+    """The caller as described by their access token's claims."""
+    id: int
+    email: str
+    role: str
+    is_approved: bool
+    departement: Optional[str] = None
+
+def user_claims(user) -> dict:
+    return {
+        "sub": user.email,
+        "uid": user.id,
+        "role": user.role,
+        "approved": user.is_approved,
+        "dept": user.departement,
+    }
+
+def token_user(payload: dict) -> Optional[TokenUser]:
+    # Tokens issued before the claims were added carry only "sub"
+    if "uid" not in payload:
+        return None
+    return TokenUser(
+        id=payload["uid"],
+        email=payload["sub"],
+        role=payload["role"],
+        is_approved=payload["approved"],
+        departement=payload.get("dept"),
+    )
+
+class RevocationList:
+    """Revoked refresh tokens and per-user revocation times.
+
+    Stored in the token_revocations table, so every worker sees them.
+    Refresh tokens are checked against the table. Access tokens are checked
+    against an in-memory copy of the user revocations, refreshed from the
+    table every REVOCATION_SYNC_SECONDS by a background thread (start).
+    Entries are dropped once every token they could apply to has expired.
+    """
+
+    def __init__(self, sync_interval: float = REVOCATION_SYNC_SECONDS):
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # User id -> time before which their tokens are revoked
+        self._users: Dict[int, float] = {}
+        self._synced_at: Optional[float] = None
+        self._next_prune = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def revoke_if_unrevoked(self, token_id: str, expires_at: float, kind: str = "token") -> bool:
+        """Revoke a token or family id. False if it already was.
+
+        A single statement, so of concurrent callers only one gets True.
+        """
+        db = SessionLocal()
+        try:
+            revoked = db.execute(
+                upsert(db, TokenRevocation).values(
+                    key=f"{kind}:{token_id}", revoked_at=time.time(), expires_at=expires_at
+                ).on_conflict_do_nothing(index_elements=[TokenRevocation.key])
+            ).rowcount == 1
+            db.commit()
+            return revoked
+        finally:
+            db.close()
+
+    def is_revoked(self, payload: dict) -> bool:
+        """Whether a refresh token's family or user was revoked.
+
+        Used tokens are detected by revoke_if_unrevoked.
+        """
+        db = SessionLocal()
+        try:
+            entries = dict(db.execute(
+                select(TokenRevocation.key, TokenRevocation.revoked_at).where(
+                    TokenRevocation.key.in_([
+                        f"family:{payload['fam']}",
+                        f"user:{payload['uid']}",
+                    ])
+                )
+            ).all())
+        finally:
+            db.close()
+        user_revoked_at = entries.pop(f"user:{payload['uid']}", None)
+        return bool(entries) or (user_revoked_at is not None and payload["iat"] <= user_revoked_at)
+
+    def revoke_users(self, connection: Connection, user_ids: List[int]):
+        """Revoke every token issued to the users so far, in the connection's
+        transaction. Call revoked_users once it commits."""
+        now = time.time()
+        statement = upsert(connection, TokenRevocation).values([
+            dict(
+                key=f"user:{user_id}",
+                user_id=user_id,
+                revoked_at=now,
+                expires_at=now + REFRESH_TOKEN_EXPIRE_DAYS * 86400
+            )
+            for user_id in user_ids
+        ])
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[TokenRevocation.key],
+            set_={"revoked_at": statement.excluded.revoked_at, "expires_at": statement.excluded.expires_at}
+        ))
+
+    def revoked_users(self, user_ids: Iterable[int]):
+        """Apply committed user revocations in this process right away."""
+        now = time.time()
+        with self._lock:
+            for user_id in user_ids:
+                self._users[user_id] = max(self._users.get(user_id, 0), now)
+
+    def is_user_revoked(self, user_id: int, issued_at: float) -> bool:
+        # In memory only: called for every authenticated request
+        with self._lock:
+            revoked_at = self._users.get(user_id)
+        return revoked_at is not None and issued_at <= revoked_at
+
+    def sync(self):
+        """Load the user revocations made since the last sync."""
+        with self._sync_lock:
+            now = time.time()
+            db = SessionLocal()
+            try:
+                query = select(TokenRevocation.user_id, TokenRevocation.revoked_at)\
+                    .where(TokenRevocation.user_id.is_not(None))
+                if self._synced_at is None:
+                    query = query.where(TokenRevocation.expires_at > now)
+                else:
+                    # Margin for clock differences between workers
+                    query = query.where(TokenRevocation.revoked_at > self._synced_at - 60)
+                rows = db.execute(query).all()
+                if now >= self._next_prune:
+                    db.execute(delete(TokenRevocation).where(TokenRevocation.expires_at <= now))
+                    db.commit()
+            finally:
+                db.close()
+            with self._lock:
+                for user_id, revoked_at in rows:
+                    self._users[user_id] = max(self._users.get(user_id, 0), revoked_at)
+                if now >= self._next_prune:
+                    horizon = now - REFRESH_TOKEN_EXPIRE_DAYS * 86400
+                    self._users = {user_id: at for user_id, at in self._users.items() if at > horizon}
+                    self._next_prune = now + 3600
+            self._synced_at = now
+
+    def _loop(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception:
+                # Checked again on the next sync
+                logger.exception("Failed to load token revocations")
+
+    def start(self):
+        # Loaded before the first request is served
+        self.sync()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="revocation-sync", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+revocation_list = RevocationList()
+
+# Decoded access tokens, so repeated requests skip signature checking
+token_cache = TTLCache(maxsize=USER_CACHE_MAX_SIZE * 4, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60)
+
+def decode_access_token(token: str) -> Optional[dict]:
+    """Claims of a valid, unrevoked access token, or None."""
+    payload = token_cache.get(token)
+    if payload is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        except JWTError:
+            return None
+        if payload.get("type", "access") != "access" or payload.get("sub") is None:
+            return None
+        token_cache.set(token, payload, expires_at=payload["exp"])
+    elif payload["exp"] <= time.time():
+        return None
+    if "uid" in payload and revocation_list.is_user_revoked(payload["uid"], payload.get("iat", 0)):
+        return None
+    return payload
+
+def create_refresh_token(user, family: Optional[str] = None) -> str:
+    expire = datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    return jwt.encode(
+        {
+            "sub": user.email,
+            "uid": user.id,
+            "type": "refresh",
+            "jti": uuid.uuid4().hex,
+            # All tokens rotated from the same login share a family
+            "fam": family or uuid.uuid4().hex,
+            "iat": time.time(),
+            "exp": expire,
+        },
+        SECRET_KEY,
+        algorithm=ALGORITHM,
+    )
+
+def create_user_tokens(user, family: Optional[str] = None) -> dict:
+    access_token = create_access_token(
+        data=user_claims(user), expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    return {
+        "access_token": access_token,
+        "refresh_token": create_refresh_token(user, family),
+        "token_type": "bearer",
+    }
+
+def use_refresh_token(token: str) -> Optional[dict]:
+    """Claims of a refresh token, which is consumed (rotation).
+
+    Presenting an already used token revokes its whole family: either the
+    client or an attacker holds a stolen copy.
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    if payload.get("type") != "refresh":
+        return None
+    if revocation_list.is_revoked(payload):
+        return None
+    # Checked and consumed in one statement: of concurrent uses, one wins
+    if not revocation_list.revoke_if_unrevoked(payload["jti"], payload["exp"]):
+        revocation_list.revoke_if_unrevoked(payload["fam"], payload["exp"], kind="family")
+        return None
+    return payload
+
+def revoke_refresh_token(token: str):
+    """Log out: revoke the token's family."""
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return
+    if payload.get("type") == "refresh":
+        revocation_list.revoke_if_unrevoked(payload["fam"], payload["exp"], kind="family")
+
+def invalidate_cached_user(email: str):
+    user_cache.delete(email)
+
+def invalidate_users(db: Session, users: Iterable, revoke_tokens: bool = True):
+    """Queue invalidation of (id, email) pairs changed by bulk statements.
+
+    The mapper events below only see changes made through the ORM. Pass
+    revoke_tokens=False for changes that only grant access, such as an
+    approval: the users' cached principals are dropped, their tokens kept.
+    """
+    users = list(users)
+    if not users:
+        return
+    db.info.setdefault("invalidated_user_emails", set()).update(email for _, email in users)
+    if revoke_tokens:
+        _revoke_user_tokens(db, db.connection(), [user_id for user_id, _ in users])
+
+# Drop cached principals whenever a user row changes (approval, role,
+# deletion...). Invalidation happens once the transaction is committed so a
+# concurrent request cannot re-cache the old row in between.
+# Tokens also carry these, so changing them revokes the user's tokens, in
+# the same transaction.
+TOKEN_CLAIM_COLUMNS = ("email", "role", "is_approved", "is_active", "departement")
+
+def _revoke_user_tokens(session: Session, connection: Connection, user_ids: List[int]):
+    revocation_list.revoke_users(connection, user_ids)
+    session.info.setdefault("revoked_user_ids", set()).update(user_ids)
+
+def _queue_user_invalidation(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    emails = session.info.setdefault("invalidated_user_emails", set())
+    emails.add(target.email)
+    state = inspect(target)
+    history = state.attrs.email.history
+    emails.update(e for e in history.deleted if e)
+    changed = [column for column in TOKEN_CLAIM_COLUMNS if state.attrs[column].history.has_changes()]
+    # Approval only grants access: unapproved users hold no tokens
+    if changed and not (changed == ["is_approved"] and target.is_approved):
+        _revoke_user_tokens(session, connection, [target.id])
+
+def _queue_user_deletion(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    session.info.setdefault("invalidated_user_emails", set()).add(target.email)
+    _revoke_user_tokens(session, connection, [target.id])
+
+event.listen(User, "after_update", _queue_user_invalidation)
+event.listen(User, "after_delete", _queue_user_deletion)
+
+@event.listens_for(Session, "after_commit")
+def _flush_user_invalidations(session):
+    for email in session.info.pop("invalidated_user_emails", ()):
+        invalidate_cached_user(email)
+    revocation_list.revoked_users(session.info.pop("revoked_user_ids", ()))
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_user_invalidations(session, previous_transaction):
+    session.info.pop("invalidated_user_emails", None)
+    session.info.pop("revoked_user_ids", None)
@@ -0,0 +1,481 @@
+"""Benchmark the API endpoints against a synthetic dataset.
+
+Each endpoint is driven by concurrent clients, one endpoint at a time,
+against the app in this process (through its ASGI interface) and/or a
+uvicorn server in a subprocess. Every mode gets its own throwaway SQLite
+database seeded with the same data. For each endpoint the throughput,
+p50/p95/p99 latency and the SQL statements per request (read from
+/metrics) are printed and written to a JSON file (bench/results.json by
+default, ignored by git).
+
+Usage: python -m bench.run [--size small|medium|large] [--mode inprocess|uvicorn|both]
+                           [--requests N] [--concurrency N] [--output FILE]
+                           [--compare BASELINE]
+
+With --compare, endpoints whose p95 latency got worse by more than
+--tolerance, or that run more SQL statements per request, are reported
+and the command exits with status 1. A reference run is kept in git as
+bench/baseline.json: refresh it with --output bench/baseline.json when a
+change is expected to move the numbers, then compare against it with
+--compare bench/baseline.json.
+
+The streaming (/events), destructive (DELETE, approval) and monitoring
+endpoints are not benchmarked. Requires httpx (pip install -r bench/requirements.txt).
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Rows per dataset size (see bench/seed.py)
+SIZES = {
+    "small": dict(users=50, courses=20, materials_per_course=3, enrollments_per_user=5,
+                  notifications_per_user=20, messages_per_user=10),
+    "medium": dict(users=500, courses=200, materials_per_course=5, enrollments_per_user=10,
+                   notifications_per_user=50, messages_per_user=30),
+    "large": dict(users=5000, courses=2000, materials_per_course=5, enrollments_per_user=20,
+                  notifications_per_user=100, messages_per_user=50),
+}
+
+# Minimal file accepted by the upload endpoint
+PDF_BYTES = b"%PDF-1.4\n1 0 obj << /Type /Catalog >> endobj\ntrailer << /Root 1 0 R >>\n%%EOF\n"
+
+class Scenario:
+    """One endpoint, and how to build a valid request for it."""
+
+    def __init__(self, method: str, route: str, role: Optional[str], build: Callable,
+                 expected: Tuple[int, ...] = (200,), share: float = 1.0):
+        self.method = method
+        self.route = route
+        self.role = role
+        self.build = build
+        self.expected = expected
+        # Fraction of --requests sent (for expensive endpoints)
+        self.share = share
+
+    @property
+    def name(self) -> str:
+        return f"{self.method} {self.route}"
+
+def _enrolled(rng, fixtures):
+    user = rng.choice(fixtures["employers"])
+    return user, rng.choice(user["enrolled"])
+
+def _scenarios() -> List[Scenario]:
+    def employer(rng, fixtures):
+        return rng.choice(fixtures["employers"])
+
+    def progress_read(rng, fixtures):
+        user, course_id = _enrolled(rng, fixtures)
+        return user, f"/courses/{course_id}/progress", {}
+
+    def progress_update(rng, fixtures):
+        user, course_id = _enrolled(rng, fixtures)
+        return user, f"/courses/{course_id}/progress", {"params": {"progress_value": rng.randrange(1, 100)}}
+
+    def progress_events(rng, fixtures):
+        user = employer(rng, fixtures)
+        events = [
+            {"course_id": rng.choice(user["enrolled"]), "progress": rng.randrange(1, 100)}
+            for _ in range(10)
+        ]
+        return user, "/progress/events", {"json": {"events": events}}
+
+    def notification_read(rng, fixtures):
+        user = employer(rng, fixtures)
+        return user, f"/notifications/{rng.choice(user['notifications'])}/read", {}
+
+    def message(rng, fixtures):
+        user = employer(rng, fixtures)
+        return user, f"/messages/{rng.choice(user['messages'])}", {}
+
+    def message_read(rng, fixtures):
+        user = employer(rng, fixtures)
+        return user, f"/messages/{rng.choice(user['messages'])}/read", {}
+
+    def send_message(rng, fixtures):
+        user = employer(rng, fixtures)
+        receiver = rng.choice(fixtures["employers"])
+        return user, "/messages/", {"data": {"content": "message de test", "receiver_id": str(receiver["id"])}}
+
+    def enroll(rng, fixtures):
+        user = employer(rng, fixtures)
+        return user, f"/courses/{rng.choice(fixtures['course_ids'])}/enroll", {}
+
+    def login(rng, fixtures):
+        user = employer(rng, fixtures)
+        return None, "/token", {"data": {"username": user["email"], "password": fixtures["password"]}}
+
+    def course(rng, fixtures):
+        return None, f"/courses/{rng.choice(fixtures['course_ids'])}", {}
+
+    def materials(rng, fixtures):
+        return None, f"/courses/{rng.choice(fixtures['course_ids'])}/materials/", {}
+
+    def catalog(rng, fixtures):
+        return None, "/courses/", {"params": {"limit": 20}}
+
+    def search(rng, fixtures):
+        return employer(rng, fixtures), "/search", {"params": {"q": rng.choice(fixtures["words"])}}
+
+    def own_course(rng, fixtures):
+        return fixtures["prof"], f"/courses/{rng.choice(fixtures['prof']['courses'])}", {}
+
+    def create_course(rng, fixtures):
+        return fixtures["prof"], "/courses/", {"json": {"title": "Cours de test", "description": "description"}}
+
+    def update_course(rng, fixtures):
+        user, path, _ = own_course(rng, fixtures)
+        return user, path, {"json": {"title": "Cours modifié", "description": "description"}}
+
+    def upload(rng, fixtures):
+        user, path, _ = own_course(rng, fixtures)
+        name = f"support_{rng.randrange(10 ** 9)}.pdf"
+        return user, path + "/materials/", {"files": {"file": (name, PDF_BYTES, "application/pdf")}}
+
+    def as_user(role: str, path: str):
+        return lambda rng, fixtures: (fixtures[role] if role != "employer" else employer(rng, fixtures), path, {})
+
+    return [
+        Scenario("GET", "/courses/", None, catalog),
+        Scenario("GET", "/courses/{course_id}", None, course),
+        Scenario("GET", "/courses/{course_id}/materials/", None, materials),
+        Scenario("GET", "/search", "employer", search),
+        Scenario("GET", "/users/me", "employer", as_user("employer", "/users/me")),
+        Scenario("GET", "/me/unread", "employer", as_user("employer", "/me/unread")),
+        Scenario("GET", "/notifications/", "employer", as_user("employer", "/notifications/")),
+        Scenario("GET", "/messages/", "employer", as_user("employer", "/messages/")),
+        Scenario("GET", "/messages/{message_id}", "employer", message),
+        Scenario("GET", "/courses/{course_id}/progress", "employer", progress_read),
+        Scenario("GET", "/dashboard/employer", "employer", as_user("employer", "/dashboard/employer")),
+        Scenario("GET", "/dashboard/prof", "prof", as_user("prof", "/dashboard/prof")),
+        Scenario("GET", "/dashboard/admin", "admin", as_user("admin", "/dashboard/admin")),
+        Scenario("GET", "/admin/pending-users", "admin", as_user("admin", "/admin/pending-users")),
+        Scenario("PUT", "/courses/{course_id}/progress", "employer", progress_update),
+        Scenario("POST", "/progress/events", "employer", progress_events, expected=(202,)),
+        Scenario("PUT", "/notifications/{notification_id}/read", "employer", notification_read),
+        Scenario("PUT", "/messages/{message_id}/read", "employer", message_read),
+        Scenario("POST", "/messages/", "employer", send_message),
+        Scenario("POST", "/courses/{course_id}/enroll", "employer", enroll, expected=(200, 400)),
+        Scenario("POST", "/courses/", "prof", create_course),
+        Scenario("PUT", "/courses/{course_id}", "prof", update_course),
+        Scenario("POST", "/courses/{course_id}/materials/", "prof", upload, share=0.25),
+        # Password hashing is deliberately slow
+        Scenario("POST", "/token", None, login, share=0.1),
+    ]
+
+def _seed_database(database_url: str, sizes: dict, seed_value: int) -> dict:
+    from sqlalchemy import create_engine
+
+    from bench.seed import seed
+    from database import configure_engine, engine_options
+
+    bind = configure_engine(create_engine(database_url, **engine_options(database_url)))
+    try:
+        return seed(bind, seed=seed_value, **sizes)
+    finally:
+        bind.dispose()
+
+def _load_fixtures(database_url: str) -> dict:
+    """Users to act as, with ids of rows they are allowed to read."""
+    from sqlalchemy import create_engine, select
+    from sqlalchemy.orm import Session
+
+    from auth import create_user_tokens
+    from bench.seed import PASSWORD, WORDS
+    from models import Course, CourseProgress, Message, Notification, User
+
+    bind = create_engine(database_url)
+    with Session(bind) as db:
+        def token(user):
+            return create_user_tokens(user)["access_token"]
+
+        def ids(query):
+            return list(db.execute(query.limit(200)).scalars())
+
+        admin = db.execute(select(User).where(User.role == "admin")).scalars().first()
+        prof = db.execute(
+            select(User).join(Course, Course.instructor_id == User.id).where(User.role == "prof")
+        ).scalars().first()
+        employers = []
+        for user in db.execute(
+            select(User).where(User.role == "employer", User.is_approved.is_(True)).limit(20)
+        ).scalars():
+            employers.append({
+                "id": user.id,
+                "email": user.email,
+                "token": token(user),
+                "enrolled": ids(select(CourseProgress.course_id).where(CourseProgress.user_id == user.id)),
+                "notifications": ids(select(Notification.id).where(Notification.user_id == user.id)),
+                "messages": ids(select(Message.id).where(Message.receiver_id == user.id)),
+            })
+        # Every scenario needs rows to pick from
+        employers = [user for user in employers if user["enrolled"] and user["notifications"] and user["messages"]]
+        fixtures = {
+            "admin": {"id": admin.id, "token": token(admin)},
+            "prof": {
+                "id": prof.id,
+                "token": token(prof),
+                "courses": ids(select(Course.id).where(Course.instructor_id == prof.id)),
+            },
+            "employers": employers,
+            "course_ids": ids(select(Course.id)),
+            "password": PASSWORD,
+            "words": WORDS,
+        }
+    bind.dispose()
+    if not employers:
+        raise SystemExit("The dataset is too small: no employer has enrollments, notifications and messages")
+    return fixtures
+
+METRIC_LINE = re.compile(
+    r'^http_request_db_(queries|seconds)_(sum|count)\{method="([^"]*)",route="([^"]*)"\} (\S+)$'
+)
+
+async def _scrape(client: httpx.AsyncClient) -> Dict[Tuple[str, str, str, str], float]:
+    response = await client.get("/metrics")
+    response.raise_for_status()
+    values = {}
+    for line in response.text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            metric, kind, method, route, value = match.groups()
+            values[(metric, kind, method, route)] = float(value)
+    return values
+
+def _percentile(latencies: List[float], percentile: float) -> float:
+    # Nearest rank
+    index = max(0, min(len(latencies) - 1, int(round(percentile / 100 * len(latencies))) - 1))
+    return latencies[index]
+
+async def _run_scenario(client: httpx.AsyncClient, scenario: Scenario, fixtures: dict,
+                        requests: int, concurrency: int, warmup: int, rng: random.Random) -> dict:
+    async def send():
+        user, path, kwargs = scenario.build(rng, fixtures)
+        headers = {"Authorization": f"Bearer {user['token']}"} if user else {}
+        start = time.perf_counter()
+        response = await client.request(scenario.method, path, headers=headers, **kwargs)
+        return time.perf_counter() - start, response.status_code
+
+    for _ in range(warmup):
+        await send()
+
+    before = await _scrape(client)
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            elapsed, status_code = await send()
+            latencies.append(elapsed)
+            statuses[status_code] = statuses.get(status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    after = await _scrape(client)
+
+    def delta(metric: str, kind: str) -> float:
+        key = (metric, kind, scenario.method, scenario.route)
+        return after.get(key, 0) - before.get(key, 0)
+
+    served = delta("queries", "count")
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(count for code, count in statuses.items() if code not in scenario.expected),
+        "statuses": {str(code): count for code, count in sorted(statuses.items())},
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "queries_per_request": round(delta("queries", "sum") / served, 2) if served else None,
+        "db_ms_per_request": round(delta("seconds", "sum") / served * 1000, 3) if served else None,
+    }
+
+async def _run_all(client: httpx.AsyncClient, fixtures: dict, args) -> Dict[str, dict]:
+    results = {}
+    rng = random.Random(args.seed)
+    for scenario in _scenarios():
+        requests = max(1, int(args.requests * scenario.share))
+        results[scenario.name] = result = await _run_scenario(
+            client, scenario, fixtures, requests, args.concurrency, args.warmup, rng
+        )
+        print(
+            f"  {scenario.name:<42} {result['throughput_rps']:>9.1f} req/s"
+            f"  p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms"
+            f"  p99 {result['p99_ms']:>8.2f} ms  queries {result['queries_per_request']}"
+            + (f"  errors {result['errors']} {result['statuses']}" if result["errors"] else "")
+        )
+    return results
+
+def run_inprocess(workdir: str, args, sizes: dict) -> Dict[str, dict]:
+    # The app reads its settings on import, so this must run before
+    # anything imports the database module
+    database_url = f"sqlite:///{os.path.join(workdir, 'inprocess.db')}"
+    os.environ["DATABASE_URL"] = database_url
+    _seed_database(database_url, sizes, args.seed)
+    fixtures = _load_fixtures(database_url)
+
+    from main import app
+
+    async def drive():
+        await app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+                return await _run_all(client, fixtures, args)
+        finally:
+            await app.router.shutdown()
+
+    return asyncio.run(drive())
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_uvicorn(workdir: str, args, sizes: dict) -> Dict[str, dict]:
+    database_url = f"sqlite:///{os.path.join(workdir, 'uvicorn.db')}"
+    _seed_database(database_url, sizes, args.seed)
+    fixtures = _load_fixtures(database_url)
+
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=REPO_ROOT)
+    env.pop("ASYNC_DATABASE_URL", None)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port),
+         "--workers", str(args.uvicorn_workers), "--log-level", "warning"],
+        cwd=workdir, env=env
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        deadline = time.time() + 30
+        while True:
+            try:
+                httpx.get(base_url + "/metrics").raise_for_status()
+                break
+            except httpx.HTTPError:
+                if time.time() > deadline or server.poll() is not None:
+                    raise SystemExit("uvicorn did not start")
+                time.sleep(0.2)
+
+        async def drive():
+            limits = httpx.Limits(max_connections=args.concurrency)
+            async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+                return await _run_all(client, fixtures, args)
+
+        return asyncio.run(drive())
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(baseline: dict, current: dict, tolerance: float) -> List[str]:
+    """Regressions of `current` relative to `baseline`, one line each."""
+    regressions = []
+    for mode, results in current["results"].items():
+        for name, result in results.items():
+            previous = baseline.get("results", {}).get(mode, {}).get(name)
+            if previous is None:
+                continue
+            if result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{mode} {name}: p95 {previous['p95_ms']} ms -> {result['p95_ms']} ms"
+                )
+            # Concurrent writes make the counts vary slightly between runs
+            if (result["queries_per_request"] or 0) > (previous["queries_per_request"] or 0) + 0.5:
+                regressions.append(
+                    f"{mode} {name}: queries per request "
+                    f"{previous['queries_per_request']} -> {result['queries_per_request']}"
+                )
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API endpoints")
+    parser.add_argument("--size", choices=list(SIZES), default="small")
+    parser.add_argument("--mode", choices=["inprocess", "uvicorn", "both"], default="both")
+    parser.add_argument("--requests", type=int, default=200, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint")
+    parser.add_argument("--uvicorn-workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=os.path.join(REPO_ROOT, "bench", "results.json"))
+    parser.add_argument("--compare", help="baseline JSON file to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative p95 increase before reporting a regression")
+    args = parser.parse_args()
+
+    # Tokens are signed in this process and checked by the server
+    os.environ.setdefault("SECRET_KEY", secrets.token_hex(32))
+    sys.path.insert(0, REPO_ROOT)
+    sizes = SIZES[args.size]
+
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    # Uploads are written relative to the working directory
+    os.chdir(workdir)
+    results = {}
+    try:
+        if args.mode in ("inprocess", "both"):
+            print("In-process:")
+            results["inprocess"] = run_inprocess(workdir, args, sizes)
+        if args.mode in ("uvicorn", "both"):
+            print(f"uvicorn ({args.uvicorn_workers} worker(s)):")
+            results["uvicorn"] = run_uvicorn(workdir, args, sizes)
+    finally:
+        os.chdir(REPO_ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "size": args.size, **sizes, "seed": args.seed, "requests": args.requests,
+            "concurrency": args.concurrency, "warmup": args.warmup,
+            "uvicorn_workers": args.uvicorn_workers,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.tolerance)
+        for line in regressions:
+            print("Regression:", line)
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+if __name__ == "__main__":
+    main()
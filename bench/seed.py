@@ -0,0 +1,133 @@
+"""Synthetic dataset for the benchmarks.
+
+The same sizes and seed always produce the same rows. Rows are inserted
+in bulk, bypassing the ORM events, so the unread counters and the search
+index are rebuilt at the end.
+"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy.engine import Engine
+
+from auth import get_password_hash
+from migrations import migrate, unread_counters
+from models import Course, CourseMaterial, CourseProgress, Message, Notification, User
+from search import rebuild_index
+
+# Every seeded user can log in with this password
+PASSWORD = "benchmark"
+
+DEPARTEMENTS = ["Informatique", "Finance", "Ressources humaines", "Production", "Logistique"]
+WORDS = (
+    "réseaux sécurité gestion projet comptabilité analyse données formation "
+    "qualité maintenance production logistique management communication "
+    "programmation python base système cloud audit risque budget client "
+    "introduction avancé pratique atelier module session évaluation"
+).split()
+
+# Fixed, so timestamps do not depend on when the dataset is built
+EPOCH = datetime(2024, 1, 1)
+BATCH_SIZE = 5000
+
+def _text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+def _time(rng: random.Random) -> datetime:
+    return EPOCH + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+
+def _insert(connection, model, rows: list):
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(model.__table__.insert(), rows[start:start + BATCH_SIZE])
+
+def seed(bind: Engine, users: int, courses: int, materials_per_course: int,
+         enrollments_per_user: int, notifications_per_user: int, messages_per_user: int,
+         seed: int = 0) -> dict:
+    """Create the schema in an empty database and fill it. Returns row counts."""
+    rng = random.Random(seed)
+    migrate(bind)
+    hashed_password = get_password_hash(PASSWORD)
+
+    # One admin, one professor in ten, a few users awaiting approval
+    user_rows = []
+    for index in range(1, users + 1):
+        if index == 1:
+            role = "admin"
+        elif index % 10 == 2:
+            role = "prof"
+        else:
+            role = "employer"
+        user_rows.append(dict(
+            id=index, nom=f"Nom{index}", prenom=f"Prenom{index}",
+            departement=rng.choice(DEPARTEMENTS), role=role,
+            email=f"{role}{index}@bench.dz", telephone=f"0{index:09d}",
+            hashed_password=hashed_password, is_active=True,
+            is_approved=index % 25 != 0, created_at=_time(rng),
+        ))
+    professors = [row for row in user_rows if row["role"] == "prof"]
+    employers = [row["id"] for row in user_rows if row["role"] == "employer"]
+
+    course_rows = []
+    for index in range(1, courses + 1):
+        instructor = rng.choice(professors)
+        created_at = _time(rng)
+        course_rows.append(dict(
+            id=index, title=_text(rng, 3).capitalize(), description=_text(rng, 30),
+            instructor_id=instructor["id"], departement=instructor["departement"],
+            created_at=created_at, updated_at=created_at,
+        ))
+
+    material_rows = []
+    for course in course_rows:
+        for _ in range(materials_per_course):
+            name = f"{_text(rng, 2).replace(' ', '_')}_{len(material_rows) + 1}.pdf"
+            material_rows.append(dict(
+                id=len(material_rows) + 1, course_id=course["id"], file_name=name,
+                file_path=f"uploads/{name}", file_type="application/pdf",
+                uploaded_at=_time(rng),
+            ))
+
+    progress_rows = []
+    notification_rows = []
+    message_rows = []
+    for user_id in employers:
+        for course_id in rng.sample(range(1, courses + 1), min(enrollments_per_user, courses)):
+            progress = rng.choice([0, 10, 25, 50, 75, 100])
+            start_date = _time(rng)
+            progress_rows.append(dict(
+                user_id=user_id, course_id=course_id, progress=progress,
+                status="Terminé" if progress == 100 else "En cours",
+                start_date=start_date, last_accessed=start_date,
+                completion_date=start_date + timedelta(days=rng.randrange(60)) if progress == 100 else None,
+            ))
+        for _ in range(notifications_per_user):
+            course = rng.choice(course_rows)
+            notification_rows.append(dict(
+                user_id=user_id, title="Nouveau cours disponible",
+                message=f"Le cours '{course['title']}' a été ajouté",
+                type="course_created", is_read=rng.random() < 0.7,
+                created_at=_time(rng), related_course_id=course["id"],
+            ))
+    for user in user_rows:
+        for _ in range(messages_per_user):
+            message_rows.append(dict(
+                sender_id=user["id"], receiver_id=rng.randrange(1, users + 1),
+                content=_text(rng, 12), is_read=rng.random() < 0.7, created_at=_time(rng),
+            ))
+
+    with bind.begin() as connection:
+        _insert(connection, User, user_rows)
+        _insert(connection, Course, course_rows)
+        _insert(connection, CourseMaterial, material_rows)
+        _insert(connection, CourseProgress, progress_rows)
+        _insert(connection, Notification, notification_rows)
+        _insert(connection, Message, message_rows)
+    unread_counters(bind)
+    rebuild_index(bind)
+    return {
+        "users": len(user_rows),
+        "courses": len(course_rows),
+        "materials": len(material_rows),
+        "enrollments": len(progress_rows),
+        "notifications": len(notification_rows),
+        "messages": len(message_rows),
+    }
@@ -1,10 +1,11 @@
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine
-from models import Base, User
+from database import SessionLocal
+from migrations import migrate
+from models import User
 from auth import get_password_hash
 
-# Create all tables
-Base.metadata.create_all(bind=engine)
+# Bring the schema up to date
+migrate()
 
 def create_admin_user():
     db = SessionLocal()
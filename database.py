@@ -1,21 +1,307 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Integer, create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import URL, Connection, Engine, make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.expression import FunctionElement
+from cache import TTLCache
 from models import Base
+from contextvars import ContextVar
+from typing import Optional
 import os
+import threading
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./platform.db")
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+# Async driver used for each backend when ASYNC_DATABASE_URL is not set
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+}
+
+def get_async_database_url(database_url: str) -> str:
+    url = make_url(database_url)
+    drivername = ASYNC_DRIVERS.get(url.get_backend_name())
+    if drivername is None:
+        raise ValueError(f"No async driver configured for '{url.get_backend_name()}'")
+    return url.set(drivername=drivername).render_as_string(hide_password=False)
+
+# The default is only derived when ASYNC_DATABASE_URL is not set, so other
+# backends work by configuring their async URL explicitly
+ASYNC_SQLALCHEMY_DATABASE_URL = (
+    os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(SQLALCHEMY_DATABASE_URL)
+)
+
+# Optional read replica for the read-only dependencies (get_read_db)
+REPLICA_DATABASE_URL = os.getenv("REPLICA_DATABASE_URL")
+ASYNC_REPLICA_DATABASE_URL = os.getenv("ASYNC_REPLICA_DATABASE_URL") or (
+    get_async_database_url(REPLICA_DATABASE_URL) if REPLICA_DATABASE_URL else None
 )
+# After a user's own write, their reads stay on the primary this long so
+# they do not see replication lag
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+# Connection pool. Pre-ping and recycle only apply to server databases.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+# SQLite pragmas applied to every new connection. WAL lets readers run
+# alongside the single writer, and busy_timeout makes writers wait for the
+# lock instead of failing with "database is locked".
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Negative values are in KiB
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-64000"))
+
+class PoolMetrics:
+    """Checkout counts and time spent waiting for a pooled connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+
+    def record(self, waited: float, timed_out: bool = False):
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+class _TimedPool:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return connection
+
+class TimedQueuePool(_TimedPool, QueuePool):
+    pass
+
+class TimedAsyncQueuePool(_TimedPool, AsyncAdaptedQueuePool):
+    pass
+
+def _is_memory_sqlite(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+def engine_options(database_url: str, is_async: bool = False) -> dict:
+    """Keyword arguments for create_engine/create_async_engine."""
+    url = make_url(database_url)
+    options = {}
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        if _is_memory_sqlite(url):
+            # Keep the dialect's single-connection pool
+            return options
+    options.update(
+        poolclass=TimedAsyncQueuePool if is_async else TimedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    if url.get_backend_name() != "sqlite":
+        # Server connections can be dropped by the server or a proxy
+        options.update(pool_pre_ping=DB_POOL_PRE_PING, pool_recycle=DB_POOL_RECYCLE)
+    return options
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+def configure_engine(engine: Engine) -> Engine:
+    if engine.dialect.name == "sqlite" and not _is_memory_sqlite(engine.url):
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+def pool_status(engine: Engine) -> dict:
+    """Current pool usage and cumulative wait times for an engine."""
+    pool = engine.pool
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            checked_in=pool.checkedin(),
+            overflow=pool.overflow(),
+        )
+    metrics = getattr(pool, "metrics", None)
+    if metrics is not None:
+        status.update(
+            checkouts=metrics.checkouts,
+            timeouts=metrics.timeouts,
+            wait_seconds_total=round(metrics.wait_seconds_total, 6),
+            wait_seconds_max=round(metrics.wait_seconds_max, 6),
+        )
+    return status
+
+engine = configure_engine(create_engine(
+    SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL)
+))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    **engine_options(ASYNC_SQLALCHEMY_DATABASE_URL, is_async=True)
+)
+configure_engine(async_engine.sync_engine)
+# Objects stay usable after commit: expired attributes cannot be lazy-loaded
+# outside of an await in async code
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
+# Read replica routing
+
+# Set by the authentication dependency for the current request
+request_user_id: ContextVar[Optional[int]] = ContextVar("request_user_id", default=None)
+
+# Users who committed a write within the last READ_YOUR_WRITES_SECONDS
+recent_writers = TTLCache(maxsize=100000, ttl=READ_YOUR_WRITES_SECONDS)
+
+@event.listens_for(Session, "after_flush")
+def _record_flush(session, flush_context):
+    session.info["has_writes"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _record_statement(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["has_writes"] = True
+
+@event.listens_for(Session, "after_commit")
+def _mark_recent_writer(session):
+    if session.info.pop("has_writes", False):
+        user_id = request_user_id.get()
+        if user_id is not None:
+            recent_writers.set(user_id, True)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_writes(session, previous_transaction):
+    session.info.pop("has_writes", None)
+
+class RoutingSession(Session):
+    """Reads go to the replica and writes to the primary.
+
+    A session that has written, or whose user wrote recently, reads from
+    the primary too.
+    """
+    primary: Engine
+    replica: Engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (
+            self._flushing
+            or isinstance(clause, UpdateBase)
+            or self.info.get("has_writes")
+            or self.info.get("use_primary")
+            or recent_writers.get(request_user_id.get()) is not None
+        ):
+            return self.primary
+        return self.replica
+
+def use_primary(db: Session):
+    """Send the session's reads to the primary, when it routes them."""
+    db.info["use_primary"] = True
+
+if REPLICA_DATABASE_URL:
+    replica_engine = configure_engine(create_engine(
+        REPLICA_DATABASE_URL, **engine_options(REPLICA_DATABASE_URL)
+    ))
+    async_replica_engine = create_async_engine(
+        ASYNC_REPLICA_DATABASE_URL,
+        **engine_options(ASYNC_REPLICA_DATABASE_URL, is_async=True)
+    )
+    configure_engine(async_replica_engine.sync_engine)
+
+    class ReadSession(RoutingSession):
+        primary = engine
+        replica = replica_engine
+
+    class AsyncReadSession(RoutingSession):
+        primary = async_engine.sync_engine
+        replica = async_replica_engine.sync_engine
+
+    ReadSessionLocal = sessionmaker(class_=ReadSession, autocommit=False, autoflush=False)
+    AsyncReadSessionLocal = async_sessionmaker(
+        sync_session_class=AsyncReadSession, autoflush=False, expire_on_commit=False
+    )
+else:
+    ReadSessionLocal = SessionLocal
+    AsyncReadSessionLocal = AsyncSessionLocal
+
+def upsert(db, model):
+    """INSERT supporting on_conflict_do_nothing/do_update for the backend of a
+    session or connection."""
+    dialect = db.dialect if isinstance(db, Connection) else db.get_bind().dialect
+    if dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+class days_between(FunctionElement):
+    """Whole days elapsed between two datetime columns, like timedelta.days."""
+    type = Integer()
+    inherit_cache = True
+    name = "days_between"
+
+@compiles(days_between)
+def _days_between_default(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "CAST(floor(julianday(%s) - julianday(%s)) AS INTEGER)" % (
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
+
+@compiles(days_between, "postgresql")
+def _days_between_postgresql(element, compiler, **kw):
+    start, end = list(element.clauses)
+    return "EXTRACT(DAY FROM (%s - %s))::integer" % (
+        compiler.process(end, **kw), compiler.process(start, **kw)
+    )
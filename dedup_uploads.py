@@ -0,0 +1,107 @@
+"""Move existing uploads into the content-addressed blob store.
+
+Every CourseMaterial and Message still pointing at a legacy
+uploads/<course_id>/... or uploads/messages/<id>/... file is re-pointed at
+the blob with the same SHA-256; duplicate copies are removed. Blob files
+left without a database row for over an hour are deleted. Safe to run
+more than once.
+"""
+import hashlib
+import os
+import re
+import time
+
+from database import SessionLocal
+from migrations import migrate
+from models import Blob, CourseMaterial, Message
+from storage import BLOB_DIR, blob_path, collect_garbage, store_blob
+from utils import UPLOAD_CHUNK_SIZE, UPLOAD_DIR, StoredUpload
+
+# Legacy files are saved as <YYYYmmdd_HHMMSS>_<original name>
+LEGACY_PREFIX = re.compile(r"^\d{8}_\d{6}_")
+
+# Leave recent blob files alone: their upload may not be committed yet
+ORPHAN_MIN_AGE = 3600
+
+def file_sha256(path: str) -> str:
+    checksum = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+def legacy_upload(path: str, content_type: str) -> StoredUpload:
+    # The legacy file plays the role of the temporary file: it is moved
+    # into the store, or deleted if the content is already there
+    return StoredUpload(
+        temp_path=path,
+        filename=LEGACY_PREFIX.sub("", os.path.basename(path)),
+        content_type=content_type,
+        size=os.path.getsize(path),
+        sha256=file_sha256(path)
+    )
+
+def remove_empty_dirs(root: str):
+    for dirpath, dirnames, filenames in os.walk(root, topdown=False):
+        if dirpath != root and not os.listdir(dirpath):
+            os.rmdir(dirpath)
+
+def dedup_uploads():
+    migrate()
+
+    db = SessionLocal()
+    stats = {"migrated": 0, "duplicates": 0, "missing": 0, "orphan_blobs": 0}
+    try:
+        rows = db.query(CourseMaterial).filter(
+            CourseMaterial.blob_sha256.is_(None),
+            CourseMaterial.file_path.isnot(None)
+        ).all()
+        rows += db.query(Message).filter(
+            Message.blob_sha256.is_(None),
+            Message.file_path.isnot(None)
+        ).all()
+
+        for row in rows:
+            # Paths saved on Windows use backslashes
+            path = os.path.normpath(row.file_path.replace("\\", "/"))
+            if not os.path.exists(path):
+                stats["missing"] += 1
+                continue
+            upload = legacy_upload(path, row.file_type)
+            if os.path.exists(blob_path(upload.sha256)):
+                stats["duplicates"] += 1
+            blob = store_blob(db, upload)
+            if isinstance(row, Message) and not row.file_name:
+                row.file_name = upload.filename
+            row.file_path = blob.path
+            row.blob_sha256 = blob.sha256
+            # Commit per file so an interrupted run loses no work
+            db.commit()
+            stats["migrated"] += 1
+
+        # Unreferenced blobs whose garbage collection did not run
+        stats["orphan_blobs"] += collect_garbage(
+            sha256 for sha256, in db.query(Blob.sha256).filter(Blob.ref_count <= 0).all()
+        )
+
+        # Blob files whose row was never committed (failed request)
+        known = {path for path, in db.query(Blob.path).all()}
+        if os.path.exists(BLOB_DIR):
+            for dirpath, dirnames, filenames in os.walk(BLOB_DIR):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if path not in known and time.time() - os.path.getmtime(path) > ORPHAN_MIN_AGE:
+                        os.remove(path)
+                        stats["orphan_blobs"] += 1
+    finally:
+        db.close()
+
+    remove_empty_dirs(UPLOAD_DIR)
+    return stats
+
+if __name__ == "__main__":
+    stats = dedup_uploads()
+    print(
+        f"Migrated {stats['migrated']} files ({stats['duplicates']} duplicates removed), "
+        f"{stats['missing']} missing, {stats['orphan_blobs']} orphan blobs deleted"
+    )
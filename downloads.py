@@ -0,0 +1,130 @@
+import os
+import re
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from fastapi import HTTPException, Request, Response, status
+from fastapi.responses import StreamingResponse
+
+from utils import UPLOAD_CHUNK_SIZE
+
+# Downloads require authentication, so shared caches must not store them
+DOWNLOAD_CACHE_CONTROL = os.getenv("DOWNLOAD_CACHE_CONTROL", "private, max-age=3600")
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def file_etag(path: str, sha256: Optional[str] = None) -> str:
+    """Strong ETag from the content hash, weak one from size and mtime otherwise."""
+    if sha256:
+        return f'"{sha256}"'
+    stat = os.stat(path)
+    return f'W/"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Weak comparison, as required for If-None-Match
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in candidates
+
+def _not_modified_since(header: str, last_modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    return last_modified.replace(microsecond=0) <= since
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Return the (start, end) byte positions of a single range, both inclusive.
+
+    Returns None when the header should be ignored (multiple ranges or bad
+    syntax) and raises 416 when the range cannot be satisfied.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        start = int(first)
+        if last and int(last) < start:
+            # Invalid rather than unsatisfiable (RFC 9110, 14.1.1)
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise HTTPException(
+            status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+async def _file_chunks(path: str, start: int, length: int):
+    async with await anyio.open_file(path, "rb") as f:
+        await f.seek(start)
+        while length > 0:
+            chunk = await f.read(min(UPLOAD_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def file_download_response(
+    request: Request,
+    path: str,
+    media_type: Optional[str],
+    filename: str,
+    etag: str
+) -> Response:
+    """Serve a file with conditional GET (304) and single byte-range support."""
+    stat = os.stat(path)
+    size = stat.st_size
+    last_modified = datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": DOWNLOAD_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+    # Conditional GET: If-None-Match takes precedence over If-Modified-Since
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    elif if_modified_since is not None and _not_modified_since(if_modified_since, last_modified):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quote(filename)}"
+    start, end = 0, size - 1
+    status_code = status.HTTP_200_OK
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A stale If-Range (the client's copy changed) means: send everything.
+    # If-Range uses strong comparison, so weak ETags never match.
+    if_range_ok = if_range is None or (if_range.strip() == etag and not etag.startswith("W/"))
+    if range_header and size > 0 and if_range_ok:
+        byte_range = _parse_range(range_header, size)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    length = end - start + 1 if size > 0 else 0
+    headers["Content-Length"] = str(length)
+    if request.method == "HEAD":
+        return Response(status_code=status_code, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        _file_chunks(path, start, length),
+        status_code=status_code,
+        headers=headers,
+        media_type=media_type
+    )
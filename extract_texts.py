@@ -0,0 +1,82 @@
+"""Extract and index the text of stored files that have none yet.
+
+Blobs already processed are skipped and each result is committed as soon
+as it is ready, so the backfill can be interrupted and run again. Legacy
+uploads must first be moved into the blob store with dedup_uploads.py.
+
+Usage: python extract_texts.py [--enqueue]
+
+With --enqueue the blobs are handed to the background job workers instead
+of being processed by this command. Uploads are not extracted when the job
+queue is disabled (JOB_QUEUE_ENABLED=false): run this command instead,
+e.g. from cron.
+"""
+import sys
+from concurrent.futures import as_completed
+
+from sqlalchemy import select
+
+from database import SessionLocal
+from extraction import EXTRACT_WORKERS, UnsupportedFile, shutdown_pool, submit
+from jobs import JOB_QUEUE_ENABLED, enqueue
+from migrations import migrate
+from models import Blob, BlobText, CourseMaterial
+from services.material_text_service import save_blob_text
+
+def pending_blobs(db):
+    return db.execute(
+        select(Blob.sha256, Blob.path)
+        .outerjoin(BlobText, BlobText.sha256 == Blob.sha256)
+        .where(BlobText.sha256.is_(None))
+        .order_by(Blob.created_at)
+    ).all()
+
+def extract_texts(use_jobs: bool = False) -> dict:
+    migrate()
+
+    db = SessionLocal()
+    stats = {"done": 0, "unsupported": 0, "failed": 0, "enqueued": 0}
+    try:
+        legacy = db.query(CourseMaterial).filter(CourseMaterial.blob_sha256.is_(None)).count()
+        if legacy:
+            print(f"{legacy} materials are not in the blob store yet; run dedup_uploads.py first")
+
+        pending = pending_blobs(db)
+        if use_jobs and JOB_QUEUE_ENABLED:
+            for sha256, path in pending:
+                enqueue(db, "extract_blob_text", sha256=sha256)
+            db.commit()
+            stats["enqueued"] = len(pending)
+            return stats
+
+        # Keep every worker busy without queueing the whole backlog at once
+        batch_size = EXTRACT_WORKERS * 4
+        for start in range(0, len(pending), batch_size):
+            futures = {}
+            for sha256, path in pending[start:start + batch_size]:
+                try:
+                    futures[submit(path)] = sha256
+                except (UnsupportedFile, OSError) as e:
+                    save_blob_text(db, sha256, "unsupported", error=str(e))
+                    stats["unsupported"] += 1
+            db.commit()
+            for future in as_completed(futures):
+                sha256 = futures[future]
+                try:
+                    save_blob_text(db, sha256, "done", text=future.result())
+                    stats["done"] += 1
+                except UnsupportedFile as e:
+                    save_blob_text(db, sha256, "unsupported", error=str(e))
+                    stats["unsupported"] += 1
+                except Exception as e:
+                    save_blob_text(db, sha256, "failed", error=f"{type(e).__name__}: {e}"[:500])
+                    stats["failed"] += 1
+                db.commit()
+    finally:
+        db.close()
+        shutdown_pool()
+    return stats
+
+if __name__ == "__main__":
+    stats = extract_texts(use_jobs="--enqueue" in sys.argv[1:])
+    print(", ".join(f"{name}: {count}" for name, count in stats.items()))
@@ -0,0 +1,110 @@
+"""Plain-text extraction from uploaded PDF and DOCX files.
+
+Extraction is CPU-bound, so it runs in a pool of worker processes
+(extract_in_pool) instead of the API or job worker threads. Nothing here
+touches the database.
+"""
+import multiprocessing
+import os
+import re
+import threading
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+from xml.etree import ElementTree
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+# Seconds allowed for one file
+EXTRACT_TIMEOUT = float(os.getenv("EXTRACT_TIMEOUT", "120"))
+# Longer texts are truncated
+EXTRACTED_TEXT_MAX_CHARS = int(os.getenv("EXTRACTED_TEXT_MAX_CHARS", "500000"))
+
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+class UnsupportedFile(Exception):
+    pass
+
+def _pdf_text(path: str) -> str:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise UnsupportedFile("PDF extraction requires the 'pypdf' package")
+    pages = []
+    length = 0
+    for page in PdfReader(path).pages:
+        page_text = page.extract_text() or ""
+        pages.append(page_text)
+        length += len(page_text)
+        if length >= EXTRACTED_TEXT_MAX_CHARS:
+            break
+    return "\n".join(pages)
+
+def _docx_text(path: str) -> str:
+    with zipfile.ZipFile(path) as archive:
+        root = ElementTree.fromstring(archive.read("word/document.xml"))
+    paragraphs = (
+        "".join(node.text or "" for node in paragraph.iter(WORD_NAMESPACE + "t"))
+        for paragraph in root.iter(WORD_NAMESPACE + "p")
+    )
+    return "\n".join(paragraphs)
+
+def _is_docx(path: str) -> bool:
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return "word/document.xml" in archive.namelist()
+    except zipfile.BadZipFile:
+        return False
+
+def file_kind(path: str) -> str:
+    """"pdf" or "docx", detected from the content."""
+    with open(path, "rb") as f:
+        header = f.read(4)
+    if header == b"%PDF":
+        return "pdf"
+    if header == b"PK\x03\x04" and _is_docx(path):
+        return "docx"
+    raise UnsupportedFile("Only PDF and DOCX files are indexed")
+
+def extract_text(path: str, kind: Optional[str] = None) -> str:
+    """Text of a PDF or DOCX file."""
+    kind = kind or file_kind(path)
+    text = _pdf_text(path) if kind == "pdf" else _docx_text(path)
+    # Compact whitespace, keep paragraph breaks
+    text = re.sub(r"[ \t\r\f\v]+", " ", text)
+    text = re.sub(r"\s*\n\s*", "\n", text).strip()
+    return text[:EXTRACTED_TEXT_MAX_CHARS]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, not forked: the API process runs threads
+            _pool = ProcessPoolExecutor(
+                max_workers=EXTRACT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+def submit(path: str) -> Future:
+    # Unsupported files are rejected here, without a round trip to the pool
+    kind = file_kind(path)
+    try:
+        return get_pool().submit(extract_text, path, kind)
+    except BrokenProcessPool:
+        # A worker died (for example on a malformed file): start over
+        shutdown_pool()
+        return get_pool().submit(extract_text, path, kind)
+
+def extract_in_pool(path: str) -> str:
+    return submit(path).result(timeout=EXTRACT_TIMEOUT)
@@ -0,0 +1,434 @@
+"""Request and query instrumentation, exported on /metrics.
+
+InstrumentationMiddleware times every request and records, per route, its
+latency and the number of SQL statements it ran and the time they took.
+Statements are timed by engine events: they are added to the current
+request's RequestStats, and statements slower than SLOW_QUERY_SECONDS are
+logged; their parameters, with passwords, tokens and free text redacted,
+only at DEBUG level. Set PROFILE_REQUESTS_SECONDS to sample the
+stacks of a fraction (PROFILE_SAMPLE_RATE) of requests; the samples of the
+ones slower than that are written to PROFILE_DIR as folded stacks, the
+input format of flamegraph.pl and speedscope.
+
+Connection pool, password hashing pool and progress buffer usage are
+reported as well.
+"""
+import collections
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from auth import hash_pool
+import database
+from progress_buffer import progress_buffer
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.2"))
+# Longer parameter lists are truncated in the slow query log
+SLOW_QUERY_MAX_PARAMETERS_LENGTH = 1000
+# Parameters whose name contains one of these are not logged
+REDACTED_PARAMETERS = ("password", "token", "secret", "content", "message", "text", "body", "payload")
+# Profiling is off unless this is set
+PROFILE_REQUESTS_SECONDS = os.getenv("PROFILE_REQUESTS_SECONDS")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_INTERVAL_SECONDS = float(os.getenv("PROFILE_INTERVAL_SECONDS", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+Labels = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _labels(self, labels: Dict[str, str]) -> Labels:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """Report a total kept elsewhere (for example by a pool)."""
+        key = self._labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Gauge(Counter):
+    type = "gauge"
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # Per label values: bucket counts (not cumulative), sum
+        self._values: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._labels(labels)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * len(self.buckets), [0.0]))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            total[0] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = [(key, list(counts), total[0]) for key, (counts, total) in self._values.items()]
+        names = self.labelnames + ("le",)
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def on_collect(self, fn: Callable[[], None]) -> Callable[[], None]:
+        """Register a function that updates gauges before each render."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "Requests handled.", ("method", "route", "status")
+))
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Request latency.", ("method", "route")
+))
+http_request_queries = registry.register(Histogram(
+    "http_request_db_queries", "SQL statements run per request.", ("method", "route"),
+    buckets=QUERY_COUNT_BUCKETS
+))
+http_request_db_duration = registry.register(Histogram(
+    "http_request_db_seconds", "Time spent in SQL statements per request.", ("method", "route")
+))
+db_query_duration = registry.register(Histogram(
+    "db_query_duration_seconds", "SQL statement latency, inside and outside requests.",
+    buckets=QUERY_LATENCY_BUCKETS
+))
+db_slow_queries = registry.register(Counter(
+    "db_slow_queries_total", "SQL statements slower than SLOW_QUERY_SECONDS."
+))
+
+db_pool_checked_out = registry.register(Gauge(
+    "db_pool_checked_out", "Connections in use.", ("engine",)
+))
+db_pool_overflow = registry.register(Gauge(
+    "db_pool_overflow", "Connections open beyond the pool size.", ("engine",)
+))
+db_pool_checkouts = registry.register(Counter(
+    "db_pool_checkouts_total", "Connection checkouts.", ("engine",)
+))
+db_pool_timeouts = registry.register(Counter(
+    "db_pool_timeouts_total", "Checkouts that timed out.", ("engine",)
+))
+db_pool_wait = registry.register(Counter(
+    "db_pool_wait_seconds_total", "Time spent waiting for a connection.", ("engine",)
+))
+hash_pool_queued = registry.register(Gauge(
+    "password_hash_queued", "Password hashes waiting for a worker."
+))
+hash_pool_running = registry.register(Gauge(
+    "password_hash_running", "Password hashes being computed."
+))
+hash_pool_rejected = registry.register(Counter(
+    "password_hash_rejected_total", "Password hashes rejected because the pool was full."
+))
+
+progress_pending = registry.register(Gauge(
+    "progress_events_pending", "Course progress values waiting to be written."
+))
+progress_events = registry.register(Counter(
+    "progress_events_total", "Course progress events received."
+))
+progress_rows_written = registry.register(Counter(
+    "progress_rows_written_total", "Course progress rows written by the flush."
+))
+
+def _engines() -> Dict[str, Engine]:
+    engines = {"sync": database.engine, "async": database.async_engine.sync_engine}
+    if database.REPLICA_DATABASE_URL:
+        engines["replica"] = database.replica_engine
+        engines["async_replica"] = database.async_replica_engine.sync_engine
+    return engines
+
+@registry.on_collect
+def _collect_pools():
+    for name, engine in _engines().items():
+        status = database.pool_status(engine)
+        if "checked_out" in status:
+            db_pool_checked_out.set(status["checked_out"], engine=name)
+            db_pool_overflow.set(max(status["overflow"], 0), engine=name)
+        if "checkouts" in status:
+            db_pool_checkouts.set(status["checkouts"], engine=name)
+            db_pool_timeouts.set(status["timeouts"], engine=name)
+            db_pool_wait.set(status["wait_seconds_total"], engine=name)
+    status = hash_pool.status()
+    hash_pool_queued.set(status["queued"])
+    hash_pool_running.set(status["running"])
+    hash_pool_rejected.set(status["rejected"])
+    status = progress_buffer.status()
+    progress_pending.set(status["pending"])
+    progress_events.set(status["events"])
+    progress_rows_written.set(status["rows_written"])
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+# Set by the middleware. Thread pool calls (sync endpoints and
+# dependencies) see the same object through the copied context.
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+# SQL statement timing, for every engine
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    db_query_duration.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        db_slow_queries.inc()
+        logger.warning("Slow query (%.3fs): %s", elapsed, statement)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Slow query parameters: %.*s",
+                SLOW_QUERY_MAX_PARAMETERS_LENGTH, repr(_redact(parameters, context, executemany))
+            )
+
+def _redact(parameters, context, executemany: bool):
+    """Parameters with the sensitive values replaced.
+
+    Positional values are matched to their bind names through the compiled
+    statement; values of raw SQL, whose names are unknown, are all hidden.
+    """
+    compiled = getattr(context, "compiled", None)
+    names = getattr(compiled, "positiontup", None)
+
+    def redact_row(row):
+        if isinstance(row, dict):
+            return {name: "<redacted>" if _sensitive(name) else value for name, value in row.items()}
+        if names is None or len(names) != len(row):
+            return tuple("<redacted>" for _ in row)
+        return tuple("<redacted>" if _sensitive(name) else value for name, value in zip(names, row))
+
+    if executemany:
+        return [redact_row(row) for row in parameters]
+    return redact_row(parameters)
+
+def _sensitive(name: str) -> bool:
+    name = name.lower()
+    return any(part in name for part in REDACTED_PARAMETERS)
+
+@event.listens_for(Engine, "handle_error")
+def _discard_query_start(exception_context):
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+# Stack sampling
+
+IDLE_FILES = ("threading.py", "selectors.py", "queue.py", "thread.py")
+
+class StackSampler:
+    """Samples the stacks of every other thread until stopped.
+
+    Requests handled concurrently with the sampled one show up too.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL_SECONDS):
+        self.interval = interval
+        self.stacks: collections.Counter = collections.Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> collections.Counter:
+        self._stopped.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                # Waiting workers and the idle event loop
+                if frame.f_code.co_filename.endswith(IDLE_FILES):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+# One sampled request at a time
+_profile_lock = threading.Lock()
+
+def _start_profile() -> Optional[StackSampler]:
+    if PROFILE_REQUESTS_SECONDS is None or random.random() >= PROFILE_SAMPLE_RATE:
+        return None
+    if not _profile_lock.acquire(blocking=False):
+        return None
+    sampler = StackSampler()
+    sampler.start()
+    return sampler
+
+def _save_profile(sampler: StackSampler, method: str, route: str, elapsed: float):
+    try:
+        stacks = sampler.stop()
+        if elapsed < float(PROFILE_REQUESTS_SECONDS) or not stacks:
+            return
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "root"
+        path = os.path.join(PROFILE_DIR, f"{int(time.time() * 1000)}-{method}-{slug}.folded")
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        logger.warning("Slow request %s %s (%.3fs), profile saved to %s", method, route, elapsed, path)
+    finally:
+        _profile_lock.release()
+
+class InstrumentationMiddleware:
+    """ASGI middleware recording per-route request metrics.
+
+    Requests are labelled by route template ("/courses/{course_id}"), so
+    the label count stays bounded; unmatched paths are grouped as
+    "unmatched". The duration of streamed responses includes the stream.
+    """
+
+    def __init__(self, app, exclude_paths: Sequence[str] = ()):
+        self.app = app
+        self.exclude_paths = set(exclude_paths)
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not METRICS_ENABLED
+            or scope["type"] != "http"
+            or scope["path"] in self.exclude_paths
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        response_status = 500
+
+        async def send_wrapper(message):
+            nonlocal response_status
+            if message["type"] == "http.response.start":
+                response_status = message["status"]
+            await send(message)
+
+        sampler = _start_profile()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            # Set by the router on the scope it was given
+            route = scope.get("route")
+            route = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            http_requests.inc(method=method, route=route, status=response_status)
+            http_request_duration.observe(elapsed, method=method, route=route)
+            http_request_queries.observe(stats.queries, method=method, route=route)
+            http_request_db_duration.observe(stats.db_seconds, method=method, route=route)
+            if sampler is not None:
+                _save_profile(sampler, method, route, elapsed)
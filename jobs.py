@@ -0,0 +1,229 @@
+import json
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Set
+
+from sqlalchemy import event, inspect, or_, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal
+from models.job import Job
+
+logger = logging.getLogger(__name__)
+
+# When disabled, enqueued jobs run on a small thread pool once the caller's
+# transaction commits, each in a session of its own (never on the event loop)
+JOB_QUEUE_ENABLED = os.getenv("JOB_QUEUE_ENABLED", "true").lower() == "true"
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+# A job left "running" for longer than this (crashed worker) is picked up again
+JOB_LOCK_TIMEOUT = int(os.getenv("JOB_LOCK_TIMEOUT", "300"))
+JOB_MAX_BACKOFF = 300
+
+_tasks: Dict[str, Callable] = {}
+# Tasks only run by the queue's workers
+_queue_only: Set[str] = set()
+_wakeup = threading.Event()
+
+# Jobs run without the queue (JOB_QUEUE_ENABLED=false)
+_inline_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="inline-job")
+_inline_futures: Set[Future] = set()
+_inline_lock = threading.Lock()
+
+def job(name: str, inline: bool = True):
+    """Register a task. It is called as ``fn(db, **payload)``.
+
+    The job row is deleted in the task's transaction, so the work a task
+    commits and the removal of its job are committed together: a task
+    that commits once, at the end, is not run again after it succeeded.
+
+    Tasks registered with ``inline=False`` are too slow to run without the
+    queue; enqueueing them is a no-op when it is disabled, and they are
+    left to a command that catches up on the missing work.
+    """
+    def decorator(fn: Callable) -> Callable:
+        _tasks[name] = fn
+        if not inline:
+            _queue_only.add(name)
+        return fn
+    return decorator
+
+def enqueue(db: Session, name: str, max_attempts: int = JOB_MAX_ATTEMPTS, **payload) -> Optional[Job]:
+    """Add a job to the caller's transaction; it becomes visible on commit.
+
+    The payload must be JSON serializable.
+    """
+    if name not in _tasks:
+        raise ValueError(f"Unknown job '{name}'")
+    if not JOB_QUEUE_ENABLED:
+        if name not in _queue_only:
+            db.info.setdefault("inline_jobs", []).append((name, payload))
+        return None
+    db_job = Job(name=name, payload=json.dumps(payload), max_attempts=max_attempts)
+    db.add(db_job)
+    db.flush()
+    db.info["jobs_enqueued"] = True
+    return db_job
+
+@event.listens_for(Session, "after_commit")
+def _wake_workers(session):
+    if session.info.pop("jobs_enqueued", False):
+        _wakeup.set()
+    for name, payload in session.info.pop("inline_jobs", []):
+        # Commits can happen on the event loop (AsyncSession.run_sync)
+        future = _inline_pool.submit(_run_inline, name, payload)
+        with _inline_lock:
+            _inline_futures.add(future)
+        future.add_done_callback(_forget_inline)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_wakeup(session, previous_transaction):
+    session.info.pop("jobs_enqueued", None)
+    session.info.pop("inline_jobs", None)
+
+def _forget_inline(future: Future):
+    with _inline_lock:
+        _inline_futures.discard(future)
+
+def wait_inline_jobs(timeout: Optional[float] = None):
+    """Wait for the jobs run without the queue that are still running."""
+    with _inline_lock:
+        futures = set(_inline_futures)
+    wait(futures, timeout)
+
+def _run_inline(name: str, payload: dict):
+    db = SessionLocal()
+    try:
+        _tasks[name](db, **payload)
+        db.commit()
+    except Exception:
+        db.rollback()
+        logger.exception("Job %s failed", name)
+    finally:
+        db.close()
+
+def _dead_letter_stale(db: Session, stale: datetime):
+    """Dead-letter the jobs whose worker was lost on their last attempt."""
+    dead = db.execute(
+        update(Job)
+        .where(
+            Job.status == "running",
+            Job.locked_at < stale,
+            Job.attempts >= Job.max_attempts
+        )
+        .values(
+            status="dead",
+            locked_at=None,
+            last_error="Worker lost while running the job (lock timeout)"
+        )
+        .returning(Job.id, Job.name, Job.attempts)
+    ).all()
+    db.commit()
+    for job_id, name, attempts in dead:
+        logger.error("Job %s (%s) dead after %s attempts", job_id, name, attempts)
+
+def _claim_next(db: Session) -> Optional[Job]:
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=JOB_LOCK_TIMEOUT)
+    _dead_letter_stale(db, stale)
+    ready = or_(
+        (Job.status == "pending") & (Job.run_at <= now),
+        # Crashed workers count as failed attempts
+        (Job.status == "running") & (Job.locked_at < stale) & (Job.attempts < Job.max_attempts)
+    )
+    candidate = db.query(Job.id).filter(ready).order_by(Job.run_at).first()
+    if candidate is None:
+        return None
+    # Only one worker (thread or process) wins the conditional update
+    claimed = db.execute(
+        update(Job)
+        .where(Job.id == candidate.id, ready)
+        .values(status="running", locked_at=now, attempts=Job.attempts + 1)
+    )
+    db.commit()
+    if claimed.rowcount != 1:
+        return None
+    return db.query(Job).filter(Job.id == candidate.id).first()
+
+def _run(db: Session, db_job: Job):
+    try:
+        task = _tasks.get(db_job.name)
+        if task is None:
+            raise LookupError(f"Unknown job '{db_job.name}'")
+        # Committed by the task, with its work
+        db.delete(db_job)
+        task(db, **json.loads(db_job.payload or "{}"))
+        db.commit()
+    except Exception:
+        db.rollback()
+        if inspect(db_job).was_deleted:
+            # The task committed before failing: its work is not redone
+            logger.exception("Job %s (%s) failed after committing", db_job.id, db_job.name)
+            return
+        error = traceback.format_exc()
+        if db_job.attempts >= db_job.max_attempts:
+            # Dead-letter: kept in the table for inspection, never retried
+            db_job.status = "dead"
+            logger.error("Job %s (%s) dead after %s attempts", db_job.id, db_job.name, db_job.attempts)
+        else:
+            db_job.status = "pending"
+            db_job.run_at = datetime.utcnow() + timedelta(
+                seconds=min(JOB_MAX_BACKOFF, 2 ** db_job.attempts)
+            )
+        db_job.locked_at = None
+        db_job.last_error = error
+        db.commit()
+
+def run_pending(limit: Optional[int] = None) -> int:
+    """Run ready jobs in the current thread until none are left."""
+    processed = 0
+    while limit is None or processed < limit:
+        db = SessionLocal()
+        try:
+            db_job = _claim_next(db)
+            if db_job is None:
+                break
+            _run(db, db_job)
+            processed += 1
+        finally:
+            db.close()
+    return processed
+
+class JobWorkerPool:
+    def __init__(self, workers: int = JOB_WORKERS, poll_interval: float = JOB_POLL_INTERVAL):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if run_pending(limit=100):
+                    continue
+            except Exception:
+                logger.exception("Job worker failed to poll the queue")
+            _wakeup.wait(self.poll_interval)
+            _wakeup.clear()
+
+    def start(self):
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._loop, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        _wakeup.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        wait_inline_jobs(timeout)
+
+worker_pool = JobWorkerPool()
@@ -1,54 +1,130 @@
-from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, status, UploadFile, File, Form, Request, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
-from datetime import timedelta, datetime
+from fastapi.responses import StreamingResponse
+from sqlalchemy import case, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+from pydantic import TypeAdapter
+from datetime import datetime
 from typing import Annotated, List, Optional
+import csv
 import json
 import os
-from fastapi.responses import FileResponse
 
-from database import get_db, engine
-from models.user import User, Base
+from database import (
+    get_db,
+    get_async_db,
+    get_read_db,
+    get_async_read_db,
+    request_user_id,
+    engine,
+    async_engine,
+    days_between,
+    pool_status,
+    use_primary
+)
+from models.user import User
 from models.course import Course, CourseMaterial, CourseProgress
+from models.message import Message as MessageModel
+from models.notification import Notification as NotificationModel
 from schemas import (
     UserCreate, User as UserSchema, Token,
     CourseCreate, Course as CourseSchema,
     CourseMaterial as CourseMaterialSchema,
     UserApproval, PendingUser, Notification,
-    MessageCreate, MessageInDB
+    MessageCreate, MessageInDB, SearchResult, RefreshTokenRequest,
+    UserImportResult, BatchApproval, ProgressEventBatch
 )
 from auth import (
-    verify_password,
     get_password_hash,
-    create_access_token,
-    ACCESS_TOKEN_EXPIRE_MINUTES,
-    SECRET_KEY,
-    ALGORITHM
+    verify_and_update_password_async,
+    hash_pool,
+    TokenUser,
+    token_user,
+    decode_access_token,
+    create_user_tokens,
+    use_refresh_token,
+    revoke_refresh_token,
+    revocation_list,
+    user_cache
+)
+from utils import stream_upload, get_upload_size_limit
+from storage import store_blob
+from downloads import file_download_response, file_etag
+from pagination import NEXT_CURSOR_HEADER, decode_cursor, keyset_page, next_cursor, set_next_cursor
+from instrumentation import METRICS_ENABLED, InstrumentationMiddleware, registry as metrics_registry
+from response_cache import catalog_cache, invalidate_course
+from jobs import enqueue, worker_pool, JOB_QUEUE_ENABLED
+from migrations import migrate
+from extraction import shutdown_pool
+from progress_buffer import progress_buffer
+from push import (
+    hub,
+    format_event_id,
+    parse_event_id,
+    PUSH_BATCH_SIZE,
+    PUSH_KEEPALIVE_SECONDS,
+    PUSH_RETRY_MS
 )
-from jose import JWTError, jwt
-from utils import save_uploaded_file
 from services.notification_service import (
-    notify_course_created,
-    notify_course_deleted,
-    notify_material_added,
-    notify_course_progress,
     get_user_notifications,
-    mark_notification_as_read
+    get_notifications_since_async,
+    mark_notification_as_read,
+    mark_all_notifications_as_read,
+    progress_milestone
 )
 from services.message_service import (
-    create_message,
+    create_message_async,
     get_user_messages,
     get_message,
+    get_message_async,
+    get_messages_since_async,
     mark_message_as_read,
+    mark_all_messages_as_read,
     delete_message
 )
+from services.unread_service import get_unread_counts_async
+from services.search_service import SEARCH_TYPES, search_async
+from services.progress_service import get_enrolled_course_ids_async
+from services.user_service import import_users, read_user_rows, set_approval
+import services.material_text_service  # registers the extraction job
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+# Apply pending schema migrations on startup (or run `python migrations.py`)
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "true").lower() == "true"
 
 app = FastAPI()
 
+@app.on_event("startup")
+def migrate_database():
+    if AUTO_MIGRATE:
+        migrate(engine)
+
+@app.on_event("startup")
+def start_job_workers():
+    if JOB_QUEUE_ENABLED:
+        worker_pool.start()
+
+@app.on_event("startup")
+def start_progress_flush():
+    progress_buffer.start()
+
+@app.on_event("startup")
+def start_revocation_sync():
+    revocation_list.start()
+
+@app.on_event("shutdown")
+def stop_job_workers():
+    # Buffered progress is written first, its notifications are jobs
+    progress_buffer.stop()
+    worker_pool.stop()
+    shutdown_pool()
+
+@app.on_event("shutdown")
+def stop_revocation_sync():
+    revocation_list.stop()
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -56,44 +132,87 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
+# Per-route latency and query counts, served on /metrics
+app.add_middleware(InstrumentationMiddleware, exclude_paths=["/metrics", "/events"])
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 def get_user_by_email(db: Session, email: str):
     return db.query(User).filter(User.email == email).first()
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = get_user_by_email(db, email)
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await db.run_sync(get_user_by_email, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    # Verified in the hashing pool, off the event loop
+    valid, new_hash = await verify_and_update_password_async(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash:
+        # Hashing parameters changed since this hash was made
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
-async def get_current_user(
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+async def get_current_user_record(
     token: Annotated[str, Depends(oauth2_scheme)],
-    db: Session = Depends(get_db)
-):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-    except JWTError:
+    db: AsyncSession = Depends(get_async_db)
+) -> User:
+    """The caller's full user row, for handlers that need their profile."""
+    payload = decode_access_token(token)
+    if payload is None:
         raise credentials_exception
-    user = get_user_by_email(db, email=email)
+    email: str = payload["sub"]
+    user = user_cache.get(email)
     if user is None:
+        user = await db.run_sync(get_user_by_email, email)
+        if user is None:
+            raise credentials_exception
+        # Detach the row so it can be shared across requests without being
+        # expired by this session's commits
+        db.expunge(user)
+        user_cache.set(email, user, expires_at=payload.get("exp"))
+    # Lets the read-only sessions route this user's reads
+    request_user_id.set(user.id)
+    return user
+
+async def get_current_user(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    db: AsyncSession = Depends(get_async_db)
+) -> TokenUser:
+    """The caller as described by their token, without a database query."""
+    payload = decode_access_token(token)
+    if payload is None:
         raise credentials_exception
+    user = token_user(payload)
+    if user is None:
+        # Token issued before the claims were added
+        return await get_current_user_record(token, db)
+    request_user_id.set(user.id)
     return user
 
+async def identify_reader(
+    token: Annotated[Optional[str], Depends(optional_oauth2_scheme)]
+):
+    """On public endpoints, route reads like the caller's own if they sent a token."""
+    payload = decode_access_token(token) if token else None
+    if payload is None:
+        return
+    user = token_user(payload) or user_cache.get(payload["sub"])
+    if user is not None:
+        request_user_id.set(user.id)
+
 # Middleware to check if user is a professor
-def verify_professor(current_user: Annotated[User, Depends(get_current_user)]):
+def verify_professor(current_user: Annotated[TokenUser, Depends(get_current_user)]):
     if current_user.role != "prof":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -118,7 +237,7 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
             detail="Email already registered"
         )
     
-    hashed_password = get_password_hash(user.password)
+    hashed_password = hash_pool.submit(get_password_hash, user.password).result()
     db_user = User(
         nom=user.nom,
         prenom=user.prenom,
@@ -137,8 +256,8 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
 
 @app.get("/admin/pending-users", response_model=List[PendingUser])
 def get_pending_users(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: Session = Depends(get_read_db)
 ):
     # Check if current user is admin
     if current_user.role != "admin":
@@ -154,7 +273,7 @@ def get_pending_users(
 def approve_user(
     user_id: int,
     approval: UserApproval,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     # Check if current user is admin
@@ -178,11 +297,53 @@ def approve_user(
     db.refresh(user)
     return user
 
+@app.post("/admin/users/approval")
+def approve_users(
+    approval: BatchApproval,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    # Check if current user is admin
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admin can approve users"
+        )
+    
+    # Approve or reject every listed user in one statement
+    updated = set_approval(db, approval.user_ids, approval.is_approved)
+    db.commit()
+    return {"updated": updated}
+
+@app.post("/admin/users/import", response_model=UserImportResult)
+def bulk_import_users(
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    file: UploadFile = File(...),
+    approve: bool = Form(True),
+    db: Session = Depends(get_db)
+):
+    # Check if current user is admin
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admin can import users"
+        )
+    
+    # CSV with a header row, or JSON Lines (.jsonl), read one record at a time
+    try:
+        return import_users(db, read_user_rows(file.file, file.filename or ""), approve)
+    except (UnicodeDecodeError, csv.Error) as e:
+        # Batches before the unreadable line are already imported
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unreadable file: {e}"
+        )
+
 
 @app.delete("/admin/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_user(
     user_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     # Check if current user is admin
@@ -207,18 +368,58 @@ def delete_user(
             detail="Admin cannot delete their own account"
         )
     
-    # Delete the user
+    # Delete the user (their courses lose their instructor)
+    for course in user.courses:
+        invalidate_course(db, course.id)
     db.delete(user)
     db.commit()
     return None
 
+@app.get("/admin/hash-pool")
+async def get_hash_pool_status(
+    current_user: Annotated[TokenUser, Depends(get_current_user)]
+):
+    # Check if current user is admin
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admin can view password hashing pool status"
+        )
+    
+    return hash_pool.status()
+
+@app.get("/admin/db-pool")
+async def get_db_pool_status(
+    current_user: Annotated[TokenUser, Depends(get_current_user)]
+):
+    # Check if current user is admin
+    if current_user.role != "admin":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only admin can view database pool status"
+        )
+    
+    return {
+        "sync": pool_status(engine),
+        "async": pool_status(async_engine.sync_engine)
+    }
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    # Prometheus scrape endpoint
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return Response(
+        content=metrics_registry.render(),
+        media_type="text/plain; version=0.0.4"
+    )
 
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -233,32 +434,70 @@ async def login_for_access_token(
             detail="Account not approved yet. Please wait for admin approval.",
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return create_user_tokens(user)
 
-@app.get("/users/me")
-async def read_users_me(
-    current_user: Annotated[User, Depends(get_current_user)],
+@app.post("/token/refresh", response_model=Token)
+def refresh_access_token(
+    refresh: RefreshTokenRequest,
     db: Session = Depends(get_db)
 ):
-    # Get user's course progress
-    progress_records = db.query(CourseProgress).filter(
-        CourseProgress.user_id == current_user.id
-    ).all()
+    # The refresh token is single use: a new one is returned. Checking it
+    # queries token_revocations, so this runs in the threadpool.
+    payload = use_refresh_token(refresh.refresh_token)
+    if payload is None:
+        raise credentials_exception
     
-    # Calculate statistics
-    total_courses = len(progress_records)
-    completed_courses = sum(1 for p in progress_records if p.is_completed)
-    average_progress = sum(p.progress for p in progress_records) / total_courses if total_courses > 0 else 0
+    # Reload the user so the new access token carries current claims
+    user = get_user_by_email(db, payload["sub"])
+    if user is None or not user.is_approved:
+        raise credentials_exception
     
-    # Calculate average completion time for completed courses
-    completion_times = [(p.completion_date - p.start_date).days 
-                       for p in progress_records 
-                       if p.is_completed and p.completion_date]
-    avg_completion_time = sum(completion_times) / len(completion_times) if completion_times else 0
+    return create_user_tokens(user, family=payload["fam"])
+
+@app.post("/token/revoke")
+def revoke_token(refresh: RefreshTokenRequest):
+    revoke_refresh_token(refresh.refresh_token)
+    return {"message": "Token revoked"}
+
+@app.get("/users/me")
+async def read_users_me(
+    current_user: Annotated[User, Depends(get_current_user_record)],
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    # Calculate statistics in a single aggregate query
+    stats = (await db.execute(
+        select(
+            func.count(CourseProgress.id),
+            func.sum(case((CourseProgress.is_completed == True, 1), else_=0)),
+            func.avg(CourseProgress.progress),
+            # Average completion time (in days) for completed courses
+            func.avg(case(
+                (
+                    (CourseProgress.is_completed == True)
+                    & CourseProgress.completion_date.isnot(None),
+                    days_between(CourseProgress.start_date, CourseProgress.completion_date)
+                )
+            ))
+        ).filter(CourseProgress.user_id == current_user.id)
+    )).one()
+    total_courses = stats[0]
+    completed_courses = stats[1] or 0
+    average_progress = stats[2] or 0
+    avg_completion_time = stats[3] or 0
+    
+    # Get user's course progress along with the course titles
+    progress_records = (await db.execute(
+        select(
+            Course.title,
+            CourseProgress.progress,
+            CourseProgress.start_date,
+            CourseProgress.completion_date,
+            CourseProgress.last_accessed,
+            CourseProgress.status
+        )
+        .join(Course, CourseProgress.course_id == Course.id)
+        .filter(CourseProgress.user_id == current_user.id)
+    )).all()
     
     return {
         "profile": {
@@ -277,7 +516,7 @@ async def read_users_me(
         },
         "courses": [
             {
-                "nom_du_cours": progress.course.title,
+                "nom_du_cours": progress.title,
                 "progres": f"{progress.progress:.1f}%",
                 "date_debut": progress.start_date.strftime("%d/%m/%Y"),
                 "date_fin": progress.completion_date.strftime("%d/%m/%Y") if progress.completion_date else "En cours...",
@@ -290,10 +529,19 @@ async def read_users_me(
     }
 
 # Course endpoints
+
+# Serializers for the cached catalog responses
+course_adapter = TypeAdapter(CourseSchema)
+course_list_adapter = TypeAdapter(List[CourseSchema])
+material_list_adapter = TypeAdapter(List[CourseMaterialSchema])
+
+def serialize(adapter: TypeAdapter, value) -> bytes:
+    return adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+
 @app.post("/courses/", response_model=CourseSchema)
 def create_course(
     course: CourseCreate,
-    current_user: Annotated[User, Depends(verify_professor)],
+    current_user: Annotated[TokenUser, Depends(verify_professor)],
     db: Session = Depends(get_db)
 ):
     db_course = Course(
@@ -302,42 +550,67 @@ def create_course(
         instructor_id=current_user.id
     )
     db.add(db_course)
-    db.commit()
-    db.refresh(db_course)
+    db.flush()
     
     # Notify admin about new course
-    notify_course_created(db, db_course)
+    enqueue(db, "notify_course_created", course_id=db_course.id)
+    invalidate_course(db)
     
+    db.commit()
+    db.refresh(db_course)
     return db_course
 
-@app.get("/courses/", response_model=List[CourseSchema])
+@app.get("/courses/", response_model=List[CourseSchema], dependencies=[Depends(identify_reader)])
 def get_courses(
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
 ):
-    courses = db.query(Course).offset(skip).limit(limit).all()
-    return courses
+    key = catalog_cache.key("courses", ["courses"], skip=skip, limit=limit, cursor=cursor)
+    cached = catalog_cache.get(key)
+    if cached is not None:
+        return cached
+    if catalog_cache.recently_bumped(["courses"]):
+        # The replica may lag behind the write that changed the generation
+        use_primary(db)
+    
+    after = decode_cursor(cursor) if cursor else None
+    query = db.query(Course).options(selectinload(Course.materials))
+    courses = keyset_page(query, Course.created_at, Course.id, after)\
+        .offset(skip)\
+        .limit(limit)\
+        .all()
+    cursor = next_cursor(courses, limit)
+    headers = {NEXT_CURSOR_HEADER: cursor} if cursor else {}
+    return catalog_cache.store(key, serialize(course_list_adapter, courses), headers)
 
-@app.get("/courses/{course_id}", response_model=CourseSchema)
+@app.get("/courses/{course_id}", response_model=CourseSchema, dependencies=[Depends(identify_reader)])
 def get_course(
     course_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
+    key = catalog_cache.key("course", [f"course:{course_id}"], course_id=course_id)
+    cached = catalog_cache.get(key)
+    if cached is not None:
+        return cached
+    if catalog_cache.recently_bumped([f"course:{course_id}"]):
+        use_primary(db)
+    
     course = db.query(Course).filter(Course.id == course_id).first()
     if course is None:
         raise HTTPException(status_code=404, detail="Course not found")
-    return course
+    return catalog_cache.store(key, serialize(course_adapter, course))
 
 @app.post("/courses/{course_id}/materials/", response_model=CourseMaterialSchema)
-def upload_course_material(
+async def upload_course_material(
     course_id: int,
-    current_user: Annotated[User, Depends(verify_professor)],
+    current_user: Annotated[TokenUser, Depends(verify_professor)],
     file: UploadFile = File(...),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Verify course exists and user is the instructor
-    course = db.query(Course).filter(Course.id == course_id).first()
+    course = await db.get(Course, course_id)
     if course is None:
         raise HTTPException(status_code=404, detail="Course not found")
     if course.instructor_id != current_user.id:
@@ -346,55 +619,113 @@ def upload_course_material(
             detail="You can only upload materials to your own courses"
         )
     
-    # Save the file
-    file_path = save_uploaded_file(file, course_id)
+    # Stream the file to disk and store it by content
+    upload = await stream_upload(file, max_size=get_upload_size_limit(current_user.role))
+    try:
+        blob = await db.run_sync(store_blob, upload)
+    finally:
+        upload.discard()
     
     # Create course material record
     db_material = CourseMaterial(
         course_id=course_id,
         file_name=file.filename,
-        file_path=file_path,
-        file_type=file.content_type
+        file_path=blob.path,
+        file_type=file.content_type,
+        blob_sha256=blob.sha256
     )
     db.add(db_material)
-    db.commit()
-    db.refresh(db_material)
+    await db.flush()
+    invalidate_course(db, course_id)
     
     # Notify admin and students about new material
-    notify_material_added(db, course, db_material)
+    await db.run_sync(
+        enqueue, "notify_material_added", course_id=course_id, material_id=db_material.id
+    )
+    # Index the file's text in the background
+    await db.run_sync(enqueue, "extract_blob_text", sha256=blob.sha256)
     
+    await db.commit()
+    await db.refresh(db_material)
     return db_material
 
-@app.get("/courses/{course_id}/materials/", response_model=List[CourseMaterialSchema])
+@app.get(
+    "/courses/{course_id}/materials/",
+    response_model=List[CourseMaterialSchema],
+    dependencies=[Depends(identify_reader)]
+)
 def get_course_materials(
     course_id: int,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
+    key = catalog_cache.key("course_materials", [f"course:{course_id}"], course_id=course_id)
+    cached = catalog_cache.get(key)
+    if cached is not None:
+        return cached
+    if catalog_cache.recently_bumped([f"course:{course_id}"]):
+        use_primary(db)
+    
     course = db.query(Course).filter(Course.id == course_id).first()
     if course is None:
         raise HTTPException(status_code=404, detail="Course not found")
-    return course.materials
+    return catalog_cache.store(key, serialize(material_list_adapter, course.materials))
+
+@app.get("/search", response_model=List[SearchResult])
+async def search_content(
+    q: str,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    type: Optional[str] = None,
+    skip: int = 0,
+    limit: int = 20,
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    """Search course titles and descriptions, material file names and messages.
+
+    `type` restricts the results to a comma-separated list of course,
+    material and message.
+    """
+    types = type.split(",") if type else None
+    if types and not set(types) <= set(SEARCH_TYPES):
+        raise HTTPException(status_code=400, detail="Invalid search type")
+    
+    return await search_async(db, current_user, q, types, skip, min(limit, 100))
+
+@app.api_route("/courses/{course_id}/materials/{material_id}/download", methods=["GET", "HEAD"])
+async def download_course_material(
+    course_id: int,
+    material_id: int,
+    request: Request,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    material = await db.scalar(
+        select(CourseMaterial).filter(
+            CourseMaterial.id == material_id,
+            CourseMaterial.course_id == course_id
+        )
+    )
+    if material is None or not material.file_path or not os.path.exists(material.file_path):
+        raise HTTPException(status_code=404, detail="Course material not found")
+    
+    return file_download_response(
+        request,
+        material.file_path,
+        media_type=material.file_type,
+        filename=material.file_name or os.path.basename(material.file_path),
+        etag=file_etag(material.file_path, material.blob_sha256)
+    )
 
 @app.post("/courses/{course_id}/enroll")
 async def enroll_in_course(
     course_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Verify course exists
-    course = db.query(Course).filter(Course.id == course_id).first()
+    course = await db.get(Course, course_id)
     if not course:
         raise HTTPException(status_code=404, detail="Course not found")
     
-    # Check if already enrolled
-    existing_progress = db.query(CourseProgress).filter(
-        CourseProgress.user_id == current_user.id,
-        CourseProgress.course_id == course_id
-    ).first()
-    
-    if existing_progress:
-        raise HTTPException(status_code=400, detail="Already enrolled in this course")
-    
     # Create new progress record with enrollment date
     progress = CourseProgress(
         user_id=current_user.id,
@@ -406,8 +737,12 @@ async def enroll_in_course(
     )
     
     db.add(progress)
-    db.commit()
-    db.refresh(progress)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Unique (user_id, course_id) enrollment
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Already enrolled in this course")
     
     return {
         "message": "Successfully enrolled in course",
@@ -421,14 +756,18 @@ async def enroll_in_course(
 @app.put("/courses/{course_id}/complete")
 async def mark_course_as_completed(
     course_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Get progress record
-    progress = db.query(CourseProgress).filter(
-        CourseProgress.user_id == current_user.id,
-        CourseProgress.course_id == course_id
-    ).first()
+    progress = await db.scalar(
+        select(CourseProgress)
+        .options(joinedload(CourseProgress.course))
+        .filter(
+            CourseProgress.user_id == current_user.id,
+            CourseProgress.course_id == course_id
+        )
+    )
     
     if not progress:
         raise HTTPException(status_code=404, detail="Not enrolled in this course")
@@ -439,8 +778,7 @@ async def mark_course_as_completed(
     progress.completion_date = datetime.utcnow()
     progress.progress = 100
     
-    db.commit()
-    db.refresh(progress)
+    await db.commit()
     
     return {
         "message": "Course marked as completed",
@@ -454,13 +792,17 @@ async def mark_course_as_completed(
 @app.get("/courses/{course_id}/progress")
 async def get_course_progress(
     course_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_read_db)
 ):
-    progress = db.query(CourseProgress).filter(
-        CourseProgress.user_id == current_user.id,
-        CourseProgress.course_id == course_id
-    ).first()
+    progress = await db.scalar(
+        select(CourseProgress)
+        .options(joinedload(CourseProgress.course))
+        .filter(
+            CourseProgress.user_id == current_user.id,
+            CourseProgress.course_id == course_id
+        )
+    )
     
     if not progress:
         raise HTTPException(status_code=404, detail="Not enrolled in this course")
@@ -481,19 +823,24 @@ async def get_course_progress(
 async def update_course_progress(
     course_id: int,
     progress_value: float,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Get progress record
-    progress = db.query(CourseProgress).filter(
-        CourseProgress.user_id == current_user.id,
-        CourseProgress.course_id == course_id
-    ).first()
+    progress = await db.scalar(
+        select(CourseProgress)
+        .options(joinedload(CourseProgress.course))
+        .filter(
+            CourseProgress.user_id == current_user.id,
+            CourseProgress.course_id == course_id
+        )
+    )
     
     if not progress:
         raise HTTPException(status_code=404, detail="Not enrolled in this course")
     
     # Update progress
+    previous_progress = progress.progress
     progress.progress = min(100, max(0, progress_value))  # Ensure progress is between 0 and 100
     progress.last_accessed = datetime.utcnow()
     
@@ -503,11 +850,16 @@ async def update_course_progress(
         progress.status = "Terminé"
         progress.completion_date = datetime.utcnow()
     
-    db.commit()
-    db.refresh(progress)
+    # Notify student when a milestone (25, 50, 75, 100%) is reached
+    milestone = progress_milestone(previous_progress, progress.progress)
+    if milestone:
+        await db.run_sync(
+            enqueue,
+            "notify_progress_updates",
+            updates=[[current_user.id, course_id, milestone]]
+        )
     
-    # Notify student about progress update
-    notify_course_progress(db, current_user.id, progress.course, progress.progress)
+    await db.commit()
     
     return {
         "course_title": progress.course.title,
@@ -516,11 +868,33 @@ async def update_course_progress(
         "last_updated": progress.last_accessed.strftime("%d/%m/%Y %H:%M")
     }
 
+@app.post("/progress/events", status_code=status.HTTP_202_ACCEPTED)
+async def ingest_progress_events(
+    batch: ProgressEventBatch,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    # Only courses the user is enrolled in, checked in one query
+    enrolled = await get_enrolled_course_ids_async(
+        db, current_user.id, [event.course_id for event in batch.events]
+    )
+    accepted = [
+        (event.course_id, min(100, max(0, event.progress)))
+        for event in batch.events
+        if event.course_id in enrolled
+    ]
+    # Written in the background by the flush thread
+    progress_buffer.add(current_user.id, accepted)
+    return {
+        "accepted": len(accepted),
+        "rejected": sorted({event.course_id for event in batch.events} - enrolled)
+    }
+
 # Dashboard routes
 @app.get("/dashboard/admin")
 async def admin_dashboard(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     if current_user.role != "admin":
         raise HTTPException(
@@ -529,12 +903,18 @@ async def admin_dashboard(
         )
     
     # Get statistics for admin dashboard
-    total_users = db.query(User).count()
-    pending_users = db.query(User).filter(User.is_approved == False).count()
-    active_users = db.query(User).filter(User.is_active == True).count()
+    total_users = await db.scalar(select(func.count()).select_from(User))
+    pending_users = await db.scalar(
+        select(func.count()).select_from(User).filter(User.is_approved == False)
+    )
+    active_users = await db.scalar(
+        select(func.count()).select_from(User).filter(User.is_active == True)
+    )
     
     # Get pending users details
-    pending_users_list = db.query(User).filter(User.is_approved == False).all()
+    pending_users_list = (await db.scalars(
+        select(User).filter(User.is_approved == False)
+    )).all()
     
     return {
         "statistics": {
@@ -558,8 +938,8 @@ async def admin_dashboard(
 
 @app.get("/dashboard/prof")
 async def prof_dashboard(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[User, Depends(get_current_user_record)],
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     if current_user.role != "prof":
         raise HTTPException(
@@ -568,7 +948,11 @@ async def prof_dashboard(
         )
     
     # Get professor's courses and materials
-    courses = db.query(Course).filter(Course.instructor_id == current_user.id).all()
+    courses = (await db.scalars(
+        select(Course)
+        .options(selectinload(Course.materials))
+        .filter(Course.instructor_id == current_user.id)
+    )).all()
     
     return {
         "user_info": {
@@ -599,8 +983,8 @@ async def prof_dashboard(
 
 @app.get("/dashboard/employer")
 async def employer_dashboard(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    current_user: Annotated[User, Depends(get_current_user_record)],
+    db: AsyncSession = Depends(get_async_read_db)
 ):
     if current_user.role != "employer":
         raise HTTPException(
@@ -608,8 +992,18 @@ async def employer_dashboard(
             detail="Access denied. employer role required."
         )
     
-    # Get all available courses
-    courses = db.query(Course).all()
+    # Get all available courses with their instructor and material count
+    # in a single statement
+    materials_count = (
+        select(CourseMaterial.course_id, func.count(CourseMaterial.id).label("count"))
+        .group_by(CourseMaterial.course_id)
+        .subquery()
+    )
+    courses = (await db.execute(
+        select(Course, func.coalesce(materials_count.c.count, 0))
+        .outerjoin(materials_count, materials_count.c.course_id == Course.id)
+        .options(joinedload(Course.instructor))
+    )).all()
     
     return {
         "user_info": {
@@ -627,9 +1021,9 @@ async def employer_dashboard(
                     "nom": course.instructor.nom,
                     "prenom": course.instructor.prenom
                 },
-                "materials_count": len(course.materials)
+                "materials_count": count
             }
-            for course in courses
+            for course, count in courses
         ]
     }
 
@@ -637,7 +1031,7 @@ async def employer_dashboard(
 def update_course(
     course_id: int,
     course: CourseCreate,
-    current_user: Annotated[User, Depends(verify_professor)],
+    current_user: Annotated[TokenUser, Depends(verify_professor)],
     db: Session = Depends(get_db)
 ):
     # Get existing course
@@ -656,6 +1050,7 @@ def update_course(
     db_course.title = course.title
     db_course.description = course.description
     db_course.updated_at = datetime.utcnow()
+    invalidate_course(db, course_id)
     
     db.commit()
     db.refresh(db_course)
@@ -664,7 +1059,7 @@ def update_course(
 @app.delete("/courses/{course_id}")
 def delete_course(
     course_id: int,
-    current_user: Annotated[User, Depends(verify_professor)],
+    current_user: Annotated[TokenUser, Depends(verify_professor)],
     db: Session = Depends(get_db)
 ):
     # Get existing course
@@ -680,10 +1075,11 @@ def delete_course(
         )
     
     # Notify admin about course deletion
-    notify_course_deleted(db, course)
+    enqueue(db, "notify_course_deleted", course_id=course.id, title=course.title)
     
     # Delete the course
     db.delete(course)
+    invalidate_course(db, course_id)
     db.commit()
     return {"message": "Course deleted successfully"}
 
@@ -691,7 +1087,7 @@ def delete_course(
 def delete_course_material(
     course_id: int,
     material_id: int,
-    current_user: Annotated[User, Depends(verify_professor)],
+    current_user: Annotated[TokenUser, Depends(verify_professor)],
     db: Session = Depends(get_db)
 ):
     # Get the material and verify it belongs to the specified course
@@ -712,22 +1108,28 @@ def delete_course_material(
     
     # Delete the material
     db.delete(material)
+    invalidate_course(db, course_id)
     db.commit()
     return {"message": "Course material deleted successfully"}
 
 @app.get("/notifications/", response_model=List[Notification])
 def get_notifications(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db),
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    response: Response,
+    db: Session = Depends(get_read_db),
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    cursor: Optional[str] = None
 ):
-    return get_user_notifications(db, current_user.id, skip, limit)
+    after = decode_cursor(cursor) if cursor else None
+    notifications = get_user_notifications(db, current_user.id, skip, limit, after)
+    set_next_cursor(response, notifications, limit)
+    return notifications
 
 @app.put("/notifications/{notification_id}/read")
 def mark_notification_read(
     notification_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     notification = mark_notification_as_read(db, notification_id, current_user.id)
@@ -735,50 +1137,72 @@ def mark_notification_read(
         raise HTTPException(status_code=404, detail="Notification not found")
     return {"message": "Notification marked as read"}
 
+@app.put("/notifications/read-all")
+def mark_all_notifications_read(
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    count = mark_all_notifications_as_read(db, current_user.id)
+    return {"message": f"{count} notifications marked as read"}
+
+@app.get("/me/unread")
+async def get_unread_counts(
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_read_db)
+):
+    return await get_unread_counts_async(db, current_user.id)
+
 @app.post("/messages/", response_model=MessageInDB)
 async def send_message(
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db),
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db),
     content: str = Form(...),
     receiver_id: int = Form(...),
     file: Optional[UploadFile] = File(None)
 ):
     # Verify receiver exists
-    receiver = db.query(User).filter(User.id == receiver_id).first()
+    receiver = await db.get(User, receiver_id)
     if not receiver:
         raise HTTPException(status_code=404, detail="Receiver not found")
     
-    return create_message(
+    return await create_message_async(
         db=db,
         sender_id=current_user.id,
         receiver_id=receiver_id,
         content=content,
-        file=file
+        file=file,
+        max_size=get_upload_size_limit(current_user.role)
     )
 
 @app.get("/messages/", response_model=List[MessageInDB])
 def get_messages(
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    response: Response,
     message_type: str = "received",
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db)
 ):
     if message_type not in ["received", "sent"]:
         raise HTTPException(status_code=400, detail="Invalid message type")
     
-    return get_user_messages(
+    after = decode_cursor(cursor) if cursor else None
+    messages = get_user_messages(
         db=db,
         user_id=current_user.id,
         message_type=message_type,
         skip=skip,
-        limit=limit
+        limit=limit,
+        after=after
     )
+    set_next_cursor(response, messages, limit)
+    return messages
 
 @app.get("/messages/{message_id}", response_model=MessageInDB)
 def read_message(
     message_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     message = get_message(db, message_id, current_user.id)
@@ -789,7 +1213,7 @@ def read_message(
 @app.put("/messages/{message_id}/read")
 def mark_message_read(
     message_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     message = mark_message_as_read(db, message_id, current_user.id)
@@ -797,31 +1221,122 @@ def mark_message_read(
         raise HTTPException(status_code=404, detail="Message not found")
     return {"message": "Message marked as read"}
 
+@app.put("/messages/read-all")
+def mark_all_messages_read(
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: Session = Depends(get_db)
+):
+    count = mark_all_messages_as_read(db, current_user.id)
+    return {"message": f"{count} messages marked as read"}
+
 @app.delete("/messages/{message_id}")
 def remove_message(
     message_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
     db: Session = Depends(get_db)
 ):
     if not delete_message(db, message_id, current_user.id):
         raise HTTPException(status_code=404, detail="Message not found")
     return {"message": "Message deleted successfully"}
 
-@app.get("/messages/file/{message_id}")
+@app.api_route("/messages/file/{message_id}", methods=["GET", "HEAD"])
 async def get_message_file(
     message_id: int,
-    current_user: Annotated[User, Depends(get_current_user)],
-    db: Session = Depends(get_db)
+    request: Request,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db)
 ):
-    message = get_message(db, message_id, current_user.id)
+    message = await get_message_async(db, message_id, current_user.id)
     if not message or not message.file_path:
         raise HTTPException(status_code=404, detail="File not found")
     
     if not os.path.exists(message.file_path):
         raise HTTPException(status_code=404, detail="File not found")
     
-    return FileResponse(
+    return file_download_response(
+        request,
         message.file_path,
         media_type=message.file_type,
-        filename=os.path.basename(message.file_path)
+        filename=message.file_name or os.path.basename(message.file_path),
+        etag=file_etag(message.file_path, message.blob_sha256)
+    )
+
+@app.get("/events")
+async def stream_events(
+    request: Request,
+    current_user: Annotated[TokenUser, Depends(get_current_user)],
+    db: AsyncSession = Depends(get_async_db),
+    last_event_id: Optional[str] = None
+):
+    """Server-sent events for new notifications and received messages.
+
+    Reconnecting with the Last-Event-ID header (or ?last_event_id=) resumes
+    right after the last event received.
+    """
+    user_id = current_user.id
+    resume = request.headers.get("last-event-id") or last_event_id
+    # Subscribe first so nothing committed meanwhile is missed
+    subscription = hub.subscribe(user_id)
+    try:
+        if resume:
+            position = parse_event_id(resume)
+        else:
+            latest = await db.execute(select(
+                select(func.max(NotificationModel.id))
+                .where(NotificationModel.user_id == user_id)
+                .scalar_subquery(),
+                select(func.max(MessageModel.id))
+                .where(MessageModel.receiver_id == user_id)
+                .scalar_subquery()
+            ))
+            position = tuple(id or 0 for id in latest.one())
+    except BaseException:
+        hub.unsubscribe(subscription)
+        raise
+    finally:
+        # Don't hold a pooled connection for the life of the stream
+        await db.close()
+
+    async def events():
+        notification_id, message_id = position
+        kinds = {"notification", "message"} if resume else set()
+        try:
+            yield f"retry: {PUSH_RETRY_MS}\n\n"
+            while True:
+                if not kinds:
+                    yield ": keep-alive\n\n"
+                    # Events published by other processes never reach the
+                    # hub: catch up from the database on every keep-alive
+                    kinds = {"notification", "message"}
+                try:
+                    while "notification" in kinds:
+                        notifications = await get_notifications_since_async(
+                            db, user_id, notification_id, PUSH_BATCH_SIZE
+                        )
+                        for notification in notifications:
+                            notification_id = notification.id
+                            data = Notification.model_validate(notification).model_dump_json()
+                            yield f"id: {format_event_id((notification_id, message_id))}\nevent: notification\ndata: {data}\n\n"
+                        if len(notifications) < PUSH_BATCH_SIZE:
+                            kinds.discard("notification")
+                    while "message" in kinds:
+                        messages = await get_messages_since_async(
+                            db, user_id, message_id, PUSH_BATCH_SIZE
+                        )
+                        for message in messages:
+                            message_id = message.id
+                            data = MessageInDB.model_validate(message).model_dump_json()
+                            yield f"id: {format_event_id((notification_id, message_id))}\nevent: message\ndata: {data}\n\n"
+                        if len(messages) < PUSH_BATCH_SIZE:
+                            kinds.discard("message")
+                finally:
+                    await db.close()
+                kinds = await subscription.wait(PUSH_KEEPALIVE_SECONDS)
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
@@ -0,0 +1,180 @@
+"""Versioned schema migrations.
+
+Each migration runs once per database and is recorded in the
+schema_migrations table. Steps are idempotent (they check the live schema
+first), so a migration interrupted halfway, or run by two workers starting
+at the same time, can simply be run again.
+
+Usage: python migrations.py
+"""
+import logging
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, inspect, select, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+
+from database import engine
+from search import rebuild_index
+from models import (
+    Base, BlobText, Course, CourseMaterial, CourseProgress, Message, Notification, TokenRevocation,
+    UnreadCounter, User
+)
+
+logger = logging.getLogger(__name__)
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    migration_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String),
+    Column("applied_at", DateTime, default=datetime.utcnow),
+)
+
+# Helpers
+
+def create_table(bind: Engine, table: Table):
+    table.create(bind, checkfirst=True)
+
+def add_column(bind: Engine, table: Table, column_name: str):
+    """Add a nullable column declared on the model if the table lacks it."""
+    existing = {column["name"] for column in inspect(bind).get_columns(table.name)}
+    if column_name in existing:
+        return
+    column = table.c[column_name]
+    column_type = column.type.compile(dialect=bind.dialect)
+    with bind.begin() as connection:
+        connection.execute(text(
+            f"ALTER TABLE {table.name} ADD COLUMN {column_name} {column_type}"
+        ))
+
+def create_index(bind: Engine, table: Table, index_name: str):
+    """Create an index declared on the model if the table lacks it.
+
+    On PostgreSQL the index is built CONCURRENTLY so writes are not blocked;
+    SQLite builds it in one short write transaction.
+    """
+    existing = {index["name"] for index in inspect(bind).get_indexes(table.name)}
+    if index_name in existing:
+        return
+    index = next(index for index in table.indexes if index.name == index_name)
+    if bind.dialect.name == "postgresql":
+        index.dialect_options["postgresql"]["concurrently"] = True
+        with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+            index.create(connection)
+        index.dialect_options["postgresql"]["concurrently"] = False
+    else:
+        with bind.begin() as connection:
+            index.create(connection)
+
+# Migrations
+
+def initial_schema(bind: Engine):
+    # Tables that do not exist yet, in their current form
+    Base.metadata.create_all(bind=bind)
+
+def blob_store_and_keyset_indexes(bind: Engine):
+    add_column(bind, CourseMaterial.__table__, "blob_sha256")
+    add_column(bind, Message.__table__, "file_name")
+    add_column(bind, Message.__table__, "blob_sha256")
+    create_index(bind, Notification.__table__, "ix_notifications_user_id_created_at")
+    create_index(bind, Message.__table__, "ix_messages_receiver_id_created_at")
+    create_index(bind, Message.__table__, "ix_messages_sender_id_created_at")
+    create_index(bind, Course.__table__, "ix_courses_created_at")
+
+def hot_filter_indexes(bind: Engine):
+    # Enrollment becomes unique: keep the first of any duplicate rows
+    duplicates = (
+        "FROM course_progress WHERE id NOT IN ("
+        "SELECT min(id) FROM course_progress GROUP BY user_id, course_id)"
+    )
+    with bind.begin() as connection:
+        removed = connection.execute(text(
+            f"SELECT id, user_id, course_id, progress, is_completed {duplicates}"
+        )).all()
+        if removed:
+            logger.warning(
+                "Removing %s duplicate enrollments (id, user_id, course_id, progress, is_completed): %s",
+                len(removed), [tuple(row) for row in removed]
+            )
+            connection.execute(text(f"DELETE {duplicates}"))
+    create_index(bind, CourseProgress.__table__, "uq_course_progress_user_id_course_id")
+    create_index(bind, User.__table__, "ix_users_is_approved")
+    create_index(bind, Course.__table__, "ix_courses_departement_created_at")
+
+def unread_counters(bind: Engine):
+    create_table(bind, UnreadCounter.__table__)
+    # Backfill from the current unread rows
+    with bind.begin() as connection:
+        connection.execute(text("DELETE FROM unread_counters"))
+        connection.execute(text(
+            "INSERT INTO unread_counters (user_id, notifications, messages) "
+            "SELECT user_id, sum(notifications), sum(messages) FROM ("
+            " SELECT user_id, count(*) AS notifications, 0 AS messages"
+            " FROM notifications WHERE is_read = false AND user_id IS NOT NULL GROUP BY user_id"
+            " UNION ALL"
+            " SELECT receiver_id, 0, count(*)"
+            " FROM messages WHERE is_read = false AND receiver_id IS NOT NULL GROUP BY receiver_id"
+            ") AS unread GROUP BY user_id"
+        ))
+
+def search_index(bind: Engine):
+    # Full-text index (SQLite only), filled from the existing rows
+    rebuild_index(bind)
+
+def blob_texts(bind: Engine):
+    # Filled by the extraction jobs, or by `python extract_texts.py`
+    create_table(bind, BlobText.__table__)
+
+def single_progress_notifications(bind: Engine):
+    # Progress notifications are updated in place: keep the latest per
+    # learner and course, then recount the unread ones
+    with bind.begin() as connection:
+        connection.execute(text(
+            "DELETE FROM notifications WHERE type = 'progress_updated' AND id NOT IN ("
+            "SELECT max(id) FROM notifications WHERE type = 'progress_updated' "
+            "GROUP BY user_id, related_course_id)"
+        ))
+    create_index(bind, Notification.__table__, "uq_notifications_progress_user_id_course_id")
+    unread_counters(bind)
+
+def token_revocations(bind: Engine):
+    # Revocations were kept in each process's memory until now
+    create_table(bind, TokenRevocation.__table__)
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Engine], None]]] = [
+    (1, "initial_schema", initial_schema),
+    (2, "blob_store_and_keyset_indexes", blob_store_and_keyset_indexes),
+    (3, "hot_filter_indexes", hot_filter_indexes),
+    (4, "unread_counters", unread_counters),
+    (5, "search_index", search_index),
+    (6, "blob_texts", blob_texts),
+    (7, "single_progress_notifications", single_progress_notifications),
+    (8, "token_revocations", token_revocations),
+]
+
+def migrate(bind: Engine = engine) -> List[str]:
+    """Apply pending migrations in order and return their names."""
+    schema_migrations.create(bind, checkfirst=True)
+    with bind.connect() as connection:
+        applied = set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+    done = []
+    for version, name, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+        upgrade(bind)
+        try:
+            with bind.begin() as connection:
+                connection.execute(schema_migrations.insert().values(version=version, name=name))
+        except IntegrityError:
+            # Another process finished the same migration meanwhile
+            continue
+        done.append(name)
+    return done
+
+if __name__ == "__main__":
+    applied = migrate()
+    print(f"Applied {len(applied)} migrations: {', '.join(applied)}" if applied else "Database is up to date")
@@ -3,5 +3,10 @@ from .user import User
 from .course import Course, CourseMaterial, CourseProgress
 from .notification import Notification
 from .message import Message
+from .job import Job
+from .blob import Blob
+from .blob_text import BlobText
+from .unread_counter import UnreadCounter
+from .token_revocation import TokenRevocation
 
-__all__ = ['Base', 'User', 'Course', 'CourseMaterial', 'CourseProgress', 'Notification', 'Message'] 
\ No newline at end of file
+__all__ = ['Base', 'User', 'Course', 'CourseMaterial', 'CourseProgress', 'Notification', 'Message', 'Job', 'Blob', 'BlobText', 'UnreadCounter', 'TokenRevocation'] 
\ No newline at end of file
@@ -0,0 +1,14 @@
+from sqlalchemy import Column, Integer, String, DateTime
+from datetime import datetime
+from .base import Base
+
+class Blob(Base):
+    """A stored file, shared by every material and message with the same content."""
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    path = Column(String)
+    size = Column(Integer)
+    # Number of CourseMaterial and Message rows pointing at this blob
+    ref_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
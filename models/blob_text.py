@@ -0,0 +1,14 @@
+from sqlalchemy import Column, String, Text, DateTime, ForeignKey
+from datetime import datetime
+from .base import Base
+
+class BlobText(Base):
+    """Text extracted from a stored PDF or DOCX file, one row per blob."""
+    __tablename__ = "blob_texts"
+
+    sha256 = Column(String(64), ForeignKey("blobs.sha256", ondelete="CASCADE"), primary_key=True)
+    # "done", "unsupported" or "failed"
+    status = Column(String, nullable=False)
+    text = Column(Text, nullable=True)
+    error = Column(String, nullable=True)
+    extracted_at = Column(DateTime, default=datetime.utcnow)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Float, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Float, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .user import Base
@@ -19,10 +19,18 @@ class Course(Base):
     
     # Course materials will be stored as files in a directory
     # We'll store the file paths in the database
-    materials = relationship("CourseMaterial", back_populates="course")
+    # Deleted with the course, one by one, so their blob references are
+    # released (storage.py)
+    materials = relationship("CourseMaterial", back_populates="course", cascade="all, delete-orphan")
     progress_records = relationship("CourseProgress", back_populates="course")
     notifications = relationship("Notification", back_populates="course")
 
+    __table_args__ = (
+        # Keyset pagination of the catalog, newest first
+        Index("ix_courses_created_at", "created_at", "id"),
+        Index("ix_courses_departement_created_at", "departement", "created_at"),
+    )
+
 class CourseMaterial(Base):
     __tablename__ = "course_materials"
 
@@ -31,6 +39,7 @@ class CourseMaterial(Base):
     file_name = Column(String)
     file_path = Column(String)
     file_type = Column(String)
+    blob_sha256 = Column(String(64), ForeignKey("blobs.sha256"), nullable=True)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     
     course = relationship("Course", back_populates="materials")
@@ -38,6 +47,10 @@ class CourseMaterial(Base):
 
 class CourseProgress(Base):
     __tablename__ = "course_progress"
+    __table_args__ = (
+        # One enrollment per user and course
+        Index("uq_course_progress_user_id_course_id", "user_id", "course_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -0,0 +1,21 @@
+from sqlalchemy import Column, Integer, String, Text, DateTime, Index
+from datetime import datetime
+from .base import Base
+
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String)  # Registered task name, e.g. notify_course_created
+    payload = Column(Text)  # JSON-encoded keyword arguments
+    status = Column(String, default="pending")  # pending, running, dead
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_at = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_jobs_status_run_at", "status", "run_at"),
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .user import Base
@@ -11,10 +11,18 @@ class Message(Base):
     receiver_id = Column(Integer, ForeignKey("users.id"))
     content = Column(Text)
     file_path = Column(String, nullable=True)
+    file_name = Column(String, nullable=True)
     file_type = Column(String, nullable=True)
+    blob_sha256 = Column(String(64), ForeignKey("blobs.sha256"), nullable=True)
     is_read = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
     sender = relationship("User", foreign_keys=[sender_id], back_populates="sent_messages")
-    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages") 
\ No newline at end of file
+    receiver = relationship("User", foreign_keys=[receiver_id], back_populates="received_messages")
+
+    __table_args__ = (
+        # Keyset pagination of received and sent messages, newest first
+        Index("ix_messages_receiver_id_created_at", "receiver_id", "created_at", "id"),
+        Index("ix_messages_sender_id_created_at", "sender_id", "created_at", "id"),
+    ) 
\ No newline at end of file
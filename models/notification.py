@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Text, ForeignKey, DateTime, Boolean, Index, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .base import Base
@@ -19,4 +19,18 @@ class Notification(Base):
     # Relationships
     user = relationship("User", back_populates="notifications")
     course = relationship("Course", back_populates="notifications")
-    material = relationship("CourseMaterial", back_populates="notifications") 
\ No newline at end of file
+    material = relationship("CourseMaterial", back_populates="notifications")
+
+    __table_args__ = (
+        # Keyset pagination of a user's notifications, newest first
+        Index("ix_notifications_user_id_created_at", "user_id", "created_at", "id"),
+        # A single progress notification per learner and course, updated in place
+        Index(
+            "uq_notifications_progress_user_id_course_id",
+            "user_id",
+            "related_course_id",
+            unique=True,
+            sqlite_where=text("type = 'progress_updated'"),
+            postgresql_where=text("type = 'progress_updated'")
+        ),
+    ) 
\ No newline at end of file
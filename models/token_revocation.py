@@ -0,0 +1,18 @@
+from sqlalchemy import Column, Float, Integer, String, Index
+from .base import Base
+
+class TokenRevocation(Base):
+    """A consumed or revoked refresh token or token family, or a user whose
+    tokens issued so far are revoked. Shared by every worker."""
+    __tablename__ = "token_revocations"
+
+    # "token:<jti>", "family:<fam>" or "user:<id>"
+    key = Column(String(64), primary_key=True)
+    user_id = Column(Integer, nullable=True)  # Set for user revocations
+    revoked_at = Column(Float, nullable=False)  # Unix time
+    # Unix time after which no token the entry applies to is still valid
+    expires_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_token_revocations_revoked_at", "revoked_at"),
+    )
@@ -0,0 +1,10 @@
+from sqlalchemy import Column, Integer, ForeignKey
+from .base import Base
+
+class UnreadCounter(Base):
+    """Per-user unread counts, kept in step with notifications and messages."""
+    __tablename__ = "unread_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    notifications = Column(Integer, default=0, nullable=False)
+    messages = Column(Integer, default=0, nullable=False)
@@ -0,0 +1,46 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Response, status
+from sqlalchemy import tuple_
+
+# Keyset pagination on (created_at, id), newest first. The position is sent
+# to clients as an opaque token in the X-Next-Cursor response header.
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+Cursor = Tuple[datetime, int]
+
+def encode_cursor(created_at: datetime, id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Cursor:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(id)
+    except (ValueError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid cursor"
+        )
+
+def keyset_page(query, created_column, id_column, after: Optional[Cursor]):
+    """Order a query newest first and start it after the given position."""
+    if after is not None:
+        query = query.filter(tuple_(created_column, id_column) < tuple_(*after))
+    return query.order_by(created_column.desc(), id_column.desc())
+
+def next_cursor(items: Sequence, limit: int) -> Optional[str]:
+    # A short page is the last one
+    if items and len(items) == limit:
+        last = items[-1]
+        return encode_cursor(last.created_at, last.id)
+    return None
+
+def set_next_cursor(response: Response, items: Sequence, limit: int):
+    cursor = next_cursor(items, limit)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
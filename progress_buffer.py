@@ -0,0 +1,116 @@
+"""In-memory buffer for the course progress reported by the player.
+
+Events are coalesced to the latest value per (user_id, course_id) and
+written every PROGRESS_FLUSH_INTERVAL seconds, or as soon as
+PROGRESS_FLUSH_MAX_KEYS pairs are pending, with one UPDATE statement
+executed for all of them. The player reports every few seconds, so most
+events never reach the database.
+
+The buffer belongs to one process: values are visible to readers once
+flushed, and those not yet flushed when the process crashes are lost.
+It is flushed on shutdown. Each value keeps the time it was reported, so
+a flush does not overwrite progress written directly since then.
+"""
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Tuple
+
+from database import SessionLocal
+from services.progress_service import save_progress
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "5"))
+PROGRESS_FLUSH_MAX_KEYS = int(os.getenv("PROGRESS_FLUSH_MAX_KEYS", "5000"))
+
+Key = Tuple[int, int]
+
+class ProgressBuffer:
+    def __init__(self, interval: float = PROGRESS_FLUSH_INTERVAL, max_keys: int = PROGRESS_FLUSH_MAX_KEYS):
+        self.interval = interval
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        # One flush at a time (timer, size limit or shutdown)
+        self._flush_lock = threading.Lock()
+        # Latest (progress, reported_at) per key
+        self._pending: Dict[Key, Tuple[float, datetime]] = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.events = 0
+        self.rows_written = 0
+        self.flushes = 0
+
+    def add(self, user_id: int, events: Iterable[Tuple[int, float]]):
+        """Record (course_id, progress) events, in the order they happened."""
+        now = datetime.utcnow()
+        with self._lock:
+            for course_id, progress in events:
+                self._pending[(user_id, course_id)] = (progress, now)
+                self.events += 1
+            full = len(self._pending) >= self.max_keys
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        """Write the pending values now. Returns the number of rows written.
+
+        Values superseded by a direct write are dropped.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            db = SessionLocal()
+            try:
+                written = save_progress(db, pending)
+                db.commit()
+            except Exception:
+                db.rollback()
+                # Retried on the next flush, unless newer values arrived
+                with self._lock:
+                    for key, progress in pending.items():
+                        self._pending.setdefault(key, progress)
+                raise
+            finally:
+                db.close()
+            with self._lock:
+                self.rows_written += written
+                self.flushes += 1
+            return written
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to write course progress")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="progress-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "events": self.events,
+                "rows_written": self.rows_written,
+                "flushes": self.flushes,
+            }
+
+progress_buffer = ProgressBuffer()
@@ -0,0 +1,113 @@
+"""In-process pub/sub hub behind the /events stream.
+
+Publishers only send a wake-up per user and kind ("notification" or
+"message"); the stream then reads the new rows after the last id it
+delivered. Bulk inserts, slow clients and reconnects resuming from
+Last-Event-ID all go through that same catch-up read, so nothing is lost.
+The hub only shortens the delay: rows committed by other processes (job
+workers, other app instances) are picked up by the read each stream does
+on every keep-alive.
+"""
+import asyncio
+import os
+import threading
+from typing import Dict, Optional, Set, Tuple
+
+from fastapi import HTTPException, status
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Seconds between keep-alive comments on an idle stream
+PUSH_KEEPALIVE_SECONDS = float(os.getenv("PUSH_KEEPALIVE_SECONDS", "15"))
+# Rows read per catch-up query
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "100"))
+# Reconnect delay suggested to EventSource clients, in milliseconds
+PUSH_RETRY_MS = int(os.getenv("PUSH_RETRY_MS", "3000"))
+
+# Stream positions are sent as "<notification id>:<message id>" event ids
+Position = Tuple[int, int]
+
+def format_event_id(position: Position) -> str:
+    return "%d:%d" % position
+
+def parse_event_id(event_id: str) -> Position:
+    try:
+        notification_id, message_id = event_id.split(":")
+        return int(notification_id), int(message_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid event id"
+        )
+
+class Subscription:
+    """One connected stream. Created and consumed on the event loop."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.pending: Set[str] = set()
+        self.wakeup = asyncio.Event()
+
+    def _notify(self, kind: str):
+        self.pending.add(kind)
+        self.wakeup.set()
+
+    async def wait(self, timeout: Optional[float] = None) -> Set[str]:
+        """Return the kinds published since the last call (empty on timeout)."""
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.wakeup.clear()
+        pending, self.pending = self.pending, set()
+        return pending
+
+class PushHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions: Dict[int, Set[Subscription]] = {}
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(user_id)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id: int, kind: str):
+        # Safe from any thread: request handlers, run_sync and job workers
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._notify, kind)
+            except RuntimeError:
+                # The loop is closed (shutdown)
+                self.unsubscribe(subscription)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+hub = PushHub()
+
+def publish(db: Session, user_id: int, kind: str):
+    """Wake the user's streams once the session's transaction commits."""
+    db.info.setdefault("push_events", set()).add((user_id, kind))
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(session):
+    for user_id, kind in session.info.pop("push_events", ()):
+        hub.publish(user_id, kind)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_events(session, previous_transaction):
+    session.info.pop("push_events", None)
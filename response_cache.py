@@ -0,0 +1,179 @@
+"""Cache of serialized responses for the course catalog endpoints.
+
+Entries are keyed by route, parameters, visibility scope and the current
+generation of the data they were built from. Writers bump a generation
+(for example "courses" or "course:3") once their transaction commits, which
+makes every entry built from the old data unreachable. Entries also expire
+after RESPONSE_CACHE_TTL_SECONDS.
+
+A replica may not have a write yet when its generation is bumped. For
+READ_YOUR_WRITES_SECONDS after a bump, entries of that scope are built from
+the primary (see recently_bumped), so stale rows are not cached under the
+new generation.
+
+The default backend is in-process. Set RESPONSE_CACHE_URL to a redis://
+URL to share entries and generations between workers (needs the `redis`
+package).
+"""
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi import Response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from cache import TTLCache
+from database import READ_YOUR_WRITES_SECONDS
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL")
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "60"))
+RESPONSE_CACHE_MAX_SIZE = int(os.getenv("RESPONSE_CACHE_MAX_SIZE", "2048"))
+
+# Body and headers of a cached response
+CachedResponse = Tuple[bytes, Dict[str, str]]
+
+class MemoryBackend:
+    def __init__(self, maxsize: int, ttl: int, lag: float = READ_YOUR_WRITES_SECONDS):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.lag = lag
+        self._generations: Dict[str, int] = {}
+        self._bumped_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        return self.entries.get(key)
+
+    def set(self, key: str, value: CachedResponse):
+        self.entries.set(key, value)
+
+    def generations(self, scopes: List[str]) -> List[int]:
+        with self._lock:
+            return [self._generations.get(scope, 0) for scope in scopes]
+
+    def bump(self, scopes: Iterable[str]):
+        now = time.monotonic()
+        with self._lock:
+            for scope in scopes:
+                self._generations[scope] = self._generations.get(scope, 0) + 1
+                self._bumped_at[scope] = now
+
+    def recently_bumped(self, scopes: List[str]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            return any(now - self._bumped_at.get(scope, -self.lag) < self.lag for scope in scopes)
+
+    def clear(self):
+        self.entries.clear()
+
+class RedisBackend:
+    prefix = "response-cache:"
+
+    def __init__(self, url: str, ttl: int, lag: float = READ_YOUR_WRITES_SECONDS):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_URL requires the 'redis' package")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.lag = lag
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        headers_length = int.from_bytes(raw[:4], "big")
+        return raw[4 + headers_length:], json.loads(raw[4:4 + headers_length])
+
+    def set(self, key: str, value: CachedResponse):
+        body, headers = value
+        encoded_headers = json.dumps(headers).encode()
+        raw = len(encoded_headers).to_bytes(4, "big") + encoded_headers + body
+        self.client.set(self.prefix + key, raw, ex=self.ttl)
+
+    def generations(self, scopes: List[str]) -> List[int]:
+        values = self.client.mget([self.prefix + "generation:" + scope for scope in scopes])
+        return [int(value or 0) for value in values]
+
+    def bump(self, scopes: Iterable[str]):
+        pipeline = self.client.pipeline()
+        for scope in scopes:
+            pipeline.incr(self.prefix + "generation:" + scope)
+            if self.lag > 0:
+                pipeline.set(self.prefix + "bumped:" + scope, 1, px=int(self.lag * 1000))
+        pipeline.execute()
+
+    def recently_bumped(self, scopes: List[str]) -> bool:
+        return any(self.client.mget([self.prefix + "bumped:" + scope for scope in scopes]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+class ResponseCache:
+    def __init__(self, backend, enabled: bool = True):
+        self.backend = backend
+        self.enabled = enabled
+
+    def key(self, route: str, scopes: List[str], visibility: str = "public", **params) -> str:
+        generations = ",".join(map(str, self.backend.generations(scopes)))
+        query = "&".join(f"{name}={params[name]}" for name in sorted(params))
+        return f"{route}|{visibility}|{generations}|{query}"
+
+    def get(self, key: str) -> Optional[Response]:
+        if not self.enabled:
+            return None
+        cached = self.backend.get(key)
+        if cached is None:
+            return None
+        body, headers = cached
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def store(self, key: str, body: bytes, headers: Optional[Dict[str, str]] = None) -> Response:
+        """Cache a serialized JSON body and return it as a response."""
+        headers = headers or {}
+        if self.enabled:
+            self.backend.set(key, (body, headers))
+        return Response(content=body, media_type="application/json", headers=headers)
+
+    def bump(self, scopes: Iterable[str]):
+        self.backend.bump(scopes)
+
+    def recently_bumped(self, scopes: List[str]) -> bool:
+        """Whether a scope changed within the replica lag window.
+
+        Entries for such scopes should be built from the primary.
+        """
+        return self.enabled and self.backend.recently_bumped(scopes)
+
+if RESPONSE_CACHE_URL:
+    catalog_cache = ResponseCache(
+        RedisBackend(RESPONSE_CACHE_URL, RESPONSE_CACHE_TTL_SECONDS), RESPONSE_CACHE_ENABLED
+    )
+else:
+    catalog_cache = ResponseCache(
+        MemoryBackend(RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL_SECONDS), RESPONSE_CACHE_ENABLED
+    )
+
+def invalidate_course(db: Session, course_id: Optional[int] = None):
+    """Drop cached catalog responses for a course once the session commits.
+
+    The course list is always dropped, since it embeds every course.
+    """
+    scopes = db.info.setdefault("invalidated_cache_scopes", set())
+    scopes.add("courses")
+    if course_id is not None:
+        scopes.add(f"course:{course_id}")
+
+@event.listens_for(Session, "after_commit")
+def _bump_generations(session):
+    scopes = session.info.pop("invalidated_cache_scopes", None)
+    if scopes:
+        catalog_cache.bump(scopes)
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_invalidations(session, previous_transaction):
+    session.info.pop("invalidated_cache_scopes", None)
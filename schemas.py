@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr, constr
+from pydantic import BaseModel, EmailStr, Field, constr
 from typing import Optional, List
 from datetime import datetime
 
@@ -28,9 +28,37 @@ class UserApproval(BaseModel):
 class PendingUser(User):
     pass
 
+class UserImport(UserBase):
+    password: str
+
+class UserImportError(BaseModel):
+    line: int
+    error: str
+
+class UserImportResult(BaseModel):
+    created: int
+    duplicates: List[str]
+    errors: List[UserImportError]
+
+class ProgressEvent(BaseModel):
+    course_id: int
+    progress: float
+
+class ProgressEventBatch(BaseModel):
+    # In the order they happened: the last value per course wins
+    events: List[ProgressEvent] = Field(min_length=1, max_length=1000)
+
+class BatchApproval(BaseModel):
+    user_ids: List[int] = Field(min_length=1, max_length=1000)
+    is_approved: bool
+
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+class RefreshTokenRequest(BaseModel):
+    refresh_token: str
 
 class TokenData(BaseModel):
     email: Optional[str] = None
@@ -112,4 +140,12 @@ class MessageInDB(Message):
     receiver: User
 
     class Config:
-        from_attributes = True 
\ No newline at end of file
+        from_attributes = True
+
+class SearchResult(BaseModel):
+    type: str
+    id: int
+    title: Optional[str] = None
+    course_id: Optional[int] = None
+    snippet: Optional[str] = None
+    score: float
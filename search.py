@@ -0,0 +1,162 @@
+"""Full-text index over courses, course materials and messages.
+
+On SQLite the index is an FTS5 table kept in step with the ORM writes by
+mapper events, in the same transaction. Materials are indexed by file
+name and by the text extracted from their file, if any. Each row's rowid encodes the
+indexed object (id * 4 + kind), so updates and deletes are rowid lookups.
+Other databases have no index; search_service falls back to ILIKE there,
+as it does on SQLite until the search_index migration has created the
+table, or when SQLite was built without FTS5.
+"""
+import logging
+
+from sqlalchemy import Column, Integer, MetaData, Table, Text, event, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+from models.course import Course, CourseMaterial
+from models.message import Message
+
+logger = logging.getLogger(__name__)
+
+COURSE, MATERIAL, MESSAGE = 1, 2, 3
+
+# Not part of Base.metadata: created by the search_index migration
+search_metadata = MetaData()
+search_index = Table(
+    "search_index",
+    search_metadata,
+    Column("rowid", Integer, primary_key=True),
+    Column("title", Text),
+    Column("body", Text),
+)
+
+# Accents are folded so "etudiant" matches "étudiant"
+CREATE_SEARCH_INDEX = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "title, body, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+def search_rowid(kind: int, id: int) -> int:
+    return id * 4 + kind
+
+# Whether each engine's database has the index, looked up once per engine
+# (not on every write). Reset by rebuild_index, which the migration runs.
+_indexed_engines = {}
+
+def index_available(connection: Connection) -> bool:
+    """Whether the connection's database has the full-text index."""
+    if connection.dialect.name != "sqlite":
+        return False
+    available = _indexed_engines.get(connection.engine)
+    if available is None:
+        available = inspect(connection).has_table("search_index")
+        _indexed_engines[connection.engine] = available
+    return available
+
+# Indexed (title, body) columns per model. A material's body is the text
+# extracted from its blob.
+INDEXED = {
+    Course: (COURSE, "title", "description"),
+    CourseMaterial: (MATERIAL, "file_name", "blob_sha256"),
+    Message: (MESSAGE, None, "content"),
+}
+
+def _blob_text(connection, sha256: str) -> str:
+    return connection.execute(
+        text("SELECT text FROM blob_texts WHERE sha256 = :sha256"),
+        {"sha256": sha256}
+    ).scalar()
+
+def _document(connection, target):
+    kind, title, body = INDEXED[type(target)]
+    body_value = getattr(target, body) if body else None
+    if isinstance(target, CourseMaterial) and body_value:
+        body_value = _blob_text(connection, body_value)
+    return {
+        "rowid": search_rowid(kind, target.id),
+        "title": (getattr(target, title) if title else None) or "",
+        "body": body_value or "",
+    }
+
+def _delete(connection, target):
+    kind = INDEXED[type(target)][0]
+    connection.execute(
+        text("DELETE FROM search_index WHERE rowid = :rowid"),
+        {"rowid": search_rowid(kind, target.id)}
+    )
+
+def _indexed(mapper, connection, target):
+    if index_available(connection):
+        connection.execute(
+            text("INSERT INTO search_index (rowid, title, body) VALUES (:rowid, :title, :body)"),
+            _document(connection, target)
+        )
+
+def _reindexed(mapper, connection, target):
+    if not index_available(connection):
+        return
+    state = inspect(target)
+    columns = [column for column in INDEXED[type(target)][1:] if column]
+    if any(state.attrs[column].history.has_changes() for column in columns):
+        _delete(connection, target)
+        _indexed(mapper, connection, target)
+
+def _unindexed(mapper, connection, target):
+    if index_available(connection):
+        _delete(connection, target)
+
+for model in INDEXED:
+    event.listen(model, "after_insert", _indexed)
+    event.listen(model, "after_update", _reindexed)
+    event.listen(model, "after_delete", _unindexed)
+
+def index_blob_text(connection, sha256: str, blob_text: str):
+    """Index newly extracted text for every material stored in the blob."""
+    if not index_available(connection):
+        return
+    connection.execute(
+        text(
+            f"UPDATE search_index SET body = :body WHERE rowid IN "
+            f"(SELECT id * 4 + {MATERIAL} FROM course_materials WHERE blob_sha256 = :sha256)"
+        ),
+        {"body": blob_text, "sha256": sha256}
+    )
+
+def rebuild_index(bind: Engine):
+    """Create the index if needed and fill it from the current rows."""
+    if bind.dialect.name != "sqlite":
+        return
+    try:
+        _fill_index(bind)
+    finally:
+        # Looked up again now that the table may exist
+        _indexed_engines.pop(bind, None)
+
+def _fill_index(bind: Engine):
+    with bind.begin() as connection:
+        try:
+            connection.execute(text(CREATE_SEARCH_INDEX))
+        except OperationalError:
+            # no such module: fts5
+            logger.warning("SQLite was built without FTS5: search uses LIKE instead", exc_info=True)
+            return
+        connection.execute(text("DELETE FROM search_index"))
+        connection.execute(text(
+            f"INSERT INTO search_index (rowid, title, body) "
+            f"SELECT id * 4 + {COURSE}, coalesce(title, ''), coalesce(description, '') FROM courses"
+        ))
+        material_body = "''"
+        if inspect(connection).has_table("blob_texts"):
+            material_body = (
+                "coalesce((SELECT text FROM blob_texts "
+                "WHERE blob_texts.sha256 = course_materials.blob_sha256), '')"
+            )
+        connection.execute(text(
+            f"INSERT INTO search_index (rowid, title, body) "
+            f"SELECT id * 4 + {MATERIAL}, coalesce(file_name, ''), {material_body} FROM course_materials"
+        ))
+        connection.execute(text(
+            f"INSERT INTO search_index (rowid, title, body) "
+            f"SELECT id * 4 + {MESSAGE}, '', coalesce(content, '') FROM messages"
+        ))
@@ -2,12 +2,14 @@ from sqlalchemy.orm import Session
 from models.course import Course
 from models.user import User
 from typing import List, Optional
+from pagination import Cursor, keyset_page
 
 def get_courses(
     db: Session,
     user: User,
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    after: Optional[Cursor] = None
 ) -> List[Course]:
     query = db.query(Course)
     
@@ -24,7 +26,7 @@ def get_courses(
     elif user.role == "employer":
         query = query.filter(Course.departement == user.departement)
     
-    return query.order_by(Course.created_at.desc())\
+    return keyset_page(query, Course.created_at, Course.id, after)\
         .offset(skip)\
         .limit(limit)\
         .all()
@@ -101,4 +103,4 @@ def delete_course(
     
     db.delete(course)
     db.commit()
-    return True 
\ No newline at end of file
+    return True
@@ -0,0 +1,59 @@
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from sqlalchemy.orm import Session
+from models.blob import Blob
+from models.blob_text import BlobText
+from database import upsert
+from extraction import UnsupportedFile, extract_in_pool
+from jobs import job
+from search import index_blob_text
+from typing import Optional
+import os
+
+def save_blob_text(
+    db: Session,
+    sha256: str,
+    status: str,
+    text: str = None,
+    error: str = None
+):
+    """Record an extraction result and index the text. The caller commits."""
+    db.execute(
+        upsert(db, BlobText)
+        .values(sha256=sha256, status=status, text=text, error=error)
+        .on_conflict_do_nothing(index_elements=[BlobText.sha256])
+    )
+    if text:
+        index_blob_text(db.connection(), sha256, text)
+
+def extract_blob_text(
+    db: Session,
+    sha256: str
+) -> Optional[BlobText]:
+    """Extract and index a blob's text, unless that was already done."""
+    existing = db.get(BlobText, sha256)
+    if existing is not None:
+        return existing
+    
+    blob = db.get(Blob, sha256)
+    if blob is None or not os.path.exists(blob.path):
+        return None
+    
+    try:
+        save_blob_text(db, sha256, "done", text=extract_in_pool(blob.path))
+    except UnsupportedFile as e:
+        save_blob_text(db, sha256, "unsupported", error=str(e))
+    except (TimeoutError, BrokenProcessPool):
+        # Left to the job's retries
+        raise
+    except Exception as e:
+        # Malformed file: retrying will not help
+        save_blob_text(db, sha256, "failed", error=f"{type(e).__name__}: {e}"[:500])
+    db.commit()
+    return db.get(BlobText, sha256)
+
+# Can take up to EXTRACT_TIMEOUT: without the job queue, the text is
+# extracted by `python extract_texts.py`
+@job("extract_blob_text", inline=False)
+def extract_blob_text_job(db: Session, sha256: str):
+    extract_blob_text(db, sha256)
@@ -1,66 +1,61 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import update
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.message import Message
-from typing import List
+from typing import List, Optional
+from pagination import Cursor, keyset_page
 from fastapi import UploadFile
+from utils import UPLOAD_MAX_SIZE, StoredUpload, stream_upload
+from storage import store_blob
+from services.unread_service import add_unread, remove_unread, reset_unread
+from push import publish
 import os
-from datetime import datetime
-
-def save_message_file(file: UploadFile, message_id: int) -> tuple[str, str]:
-    # Create messages directory if it doesn't exist
-    messages_dir = "uploads/messages"
-    if not os.path.exists(messages_dir):
-        os.makedirs(messages_dir)
-    
-    # Create message-specific directory
-    message_dir = os.path.join(messages_dir, str(message_id))
-    if not os.path.exists(message_dir):
-        os.makedirs(message_dir)
-    
-    # Generate unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{timestamp}_{file.filename}"
-    file_path = os.path.join(message_dir, unique_filename)
-    
-    # Save the file
-    with open(file_path, "wb") as buffer:
-        content = file.file.read()
-        buffer.write(content)
-    
-    return file_path, file.content_type
 
 def create_message(
     db: Session,
     sender_id: int,
     receiver_id: int,
     content: str,
-    file: UploadFile = None
+    upload: StoredUpload = None
 ) -> Message:
     message = Message(
         sender_id=sender_id,
         receiver_id=receiver_id,
         content=content
     )
+    
+    # If a file was uploaded, store it by content
+    if upload:
+        blob = store_blob(db, upload)
+        message.file_path = blob.path
+        message.file_name = upload.filename
+        message.file_type = upload.content_type
+        message.blob_sha256 = blob.sha256
+    
     db.add(message)
+    add_unread(db, {receiver_id: 1}, "messages")
+    publish(db, receiver_id, "message")
     db.commit()
     db.refresh(message)
-    
-    # If file is provided, save it
-    if file:
-        file_path, file_type = save_message_file(file, message.id)
-        message.file_path = file_path
-        message.file_type = file_type
-        db.commit()
-        db.refresh(message)
-    
     return message
 
+def _mark_read(db: Session, message: Message):
+    # Conditional update so concurrent calls decrement the counter once
+    marked = db.execute(
+        update(Message)
+        .where(Message.id == message.id, Message.is_read == False)
+        .values(is_read=True)
+    ).rowcount
+    if marked:
+        remove_unread(db, message.receiver_id, "messages")
+
 def get_user_messages(
     db: Session,
     user_id: int,
     message_type: str = "received",  # "received" or "sent"
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    after: Optional[Cursor] = None
 ) -> List[Message]:
     query = db.query(Message)
     
@@ -69,11 +64,25 @@ def get_user_messages(
     else:  # sent
         query = query.filter(Message.sender_id == user_id)
     
-    return query.order_by(Message.created_at.desc())\
+    return keyset_page(query, Message.created_at, Message.id, after)\
         .offset(skip)\
         .limit(limit)\
         .all()
 
+def get_messages_since(
+    db: Session,
+    user_id: int,
+    after_id: int,
+    limit: int = 100
+) -> List[Message]:
+    # Received messages, oldest first, for the live stream
+    return db.query(Message)\
+        .options(joinedload(Message.sender), joinedload(Message.receiver))\
+        .filter(Message.receiver_id == user_id, Message.id > after_id)\
+        .order_by(Message.id)\
+        .limit(limit)\
+        .all()
+
 def get_message(
     db: Session,
     message_id: int,
@@ -87,7 +96,7 @@ def get_message(
         .first()
     
     if message and message.receiver_id == user_id and not message.is_read:
-        message.is_read = True
+        _mark_read(db, message)
         db.commit()
         db.refresh(message)
     
@@ -106,7 +115,7 @@ def mark_message_as_read(
         .first()
     
     if message:
-        message.is_read = True
+        _mark_read(db, message)
         db.commit()
         db.refresh(message)
     
@@ -125,16 +134,74 @@ def delete_message(
         .first()
     
     if message:
-        # Delete associated file if exists
-        if message.file_path and os.path.exists(message.file_path):
+        # Delete associated file if exists (stored blobs are removed once
+        # no longer referenced)
+        if message.file_path and not message.blob_sha256 and os.path.exists(message.file_path):
             os.remove(message.file_path)
             # Remove directory if empty
             message_dir = os.path.dirname(message.file_path)
             if not os.listdir(message_dir):
                 os.rmdir(message_dir)
         
+        # Counted by the row's current state, not the one loaded above
+        _mark_read(db, message)
         db.delete(message)
         db.commit()
         return True
     
-    return False 
\ No newline at end of file
+    return False
+
+def mark_all_messages_as_read(
+    db: Session,
+    user_id: int
+) -> int:
+    marked = db.execute(
+        update(Message)
+        .where(Message.receiver_id == user_id, Message.is_read == False)
+        .values(is_read=True)
+    ).rowcount
+    reset_unread(db, user_id, "messages")
+    db.commit()
+    return marked
+
+# Async versions for handlers using an AsyncSession. They run the functions
+# above through run_sync, so lazy loads happen without blocking the loop.
+
+async def create_message_async(
+    db: AsyncSession,
+    sender_id: int,
+    receiver_id: int,
+    content: str,
+    file: UploadFile = None,
+    max_size: int = UPLOAD_MAX_SIZE
+) -> Message:
+    # Stream the attachment before touching the database
+    upload = await stream_upload(file, max_size) if file else None
+
+    def _create(session: Session) -> Message:
+        message = create_message(session, sender_id, receiver_id, content, upload)
+        # Load the relationships serialized by MessageInDB while still in
+        # the greenlet
+        message.sender, message.receiver
+        return message
+
+    try:
+        return await db.run_sync(_create)
+    finally:
+        if upload:
+            upload.discard()
+
+async def get_messages_since_async(
+    db: AsyncSession,
+    user_id: int,
+    after_id: int,
+    limit: int = 100
+) -> List[Message]:
+    return await db.run_sync(get_messages_since, user_id, after_id, limit)
+
+async def get_message_async(
+    db: AsyncSession,
+    message_id: int,
+    user_id: int
+) -> Message:
+    return await db.run_sync(get_message, message_id, user_id)
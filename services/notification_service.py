@@ -1,8 +1,46 @@
+from datetime import datetime
+from sqlalchemy import delete, insert, tuple_, update
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from models.notification import Notification
 from models.user import User
-from models.course import Course
-from typing import List
+from models.course import Course, CourseMaterial, CourseProgress
+from jobs import job
+from typing import List, Optional
+from pagination import Cursor, keyset_page
+from services.unread_service import add_unread, remove_unread, reset_unread
+from push import publish
+from database import upsert
+from cache import TTLCache
+from collections import Counter
+import os
+import time
+
+# Rows per multi-row INSERT, kept under SQLite's bound-parameter limit
+NOTIFICATION_BATCH_SIZE = 500
+
+# Progress is only notified when it crosses one of these (in %)
+PROGRESS_MILESTONES = (25, 50, 75, 100)
+
+# Seconds during which the same notification (type, user, course and
+# detail) is not sent again, per type
+NOTIFICATION_DEBOUNCE_SECONDS = {
+    "progress_updated": int(os.getenv("PROGRESS_NOTIFICATION_DEBOUNCE_SECONDS", "600")),
+}
+
+# Recently sent notifications, per process
+_recently_sent = TTLCache(maxsize=100000, ttl=max(NOTIFICATION_DEBOUNCE_SECONDS.values()))
+
+def _debounced(type: str, *key) -> bool:
+    return _recently_sent.get((type,) + key) is not None
+
+def _mark_sent(type: str, *key):
+    _recently_sent.set((type,) + key, True, expires_at=time.time() + NOTIFICATION_DEBOUNCE_SECONDS[type])
+
+def progress_milestone(previous: float, progress: float) -> Optional[int]:
+    """The highest milestone reached by going from previous to progress."""
+    crossed = [m for m in PROGRESS_MILESTONES if (previous or 0) < m <= progress]
+    return crossed[-1] if crossed else None
 
 def create_notification(
     db: Session,
@@ -22,20 +60,65 @@ def create_notification(
         related_material_id=material_id
     )
     db.add(notification)
+    add_unread(db, {user_id: 1}, "notifications")
+    publish(db, user_id, "notification")
     db.commit()
     db.refresh(notification)
     return notification
 
+def create_notifications(
+    db: Session,
+    notifications: List[dict]
+) -> int:
+    """Insert many notifications with multi-row INSERTs in one transaction.
+
+    Each item takes the same keys as create_notification's arguments.
+    """
+    rows = [
+        {
+            "user_id": n["user_id"],
+            "title": n["title"],
+            "message": n["message"],
+            "type": n["type"],
+            "related_course_id": n.get("course_id"),
+            "related_material_id": n.get("material_id")
+        }
+        for n in notifications
+    ]
+    for start in range(0, len(rows), NOTIFICATION_BATCH_SIZE):
+        db.execute(insert(Notification).values(rows[start:start + NOTIFICATION_BATCH_SIZE]))
+    counts = Counter(row["user_id"] for row in rows)
+    add_unread(db, counts, "notifications")
+    for user_id in counts:
+        publish(db, user_id, "notification")
+    db.commit()
+    return len(rows)
+
 def get_user_notifications(
     db: Session,
     user_id: int,
     skip: int = 0,
+    limit: int = 100,
+    after: Optional[Cursor] = None
+) -> List[Notification]:
+    query = db.query(Notification)\
+        .filter(Notification.user_id == user_id)
+    
+    return keyset_page(query, Notification.created_at, Notification.id, after)\
+        .offset(skip)\
+        .limit(limit)\
+        .all()
+
+def get_notifications_since(
+    db: Session,
+    user_id: int,
+    after_id: int,
     limit: int = 100
 ) -> List[Notification]:
+    # Oldest first, for the live stream
     return db.query(Notification)\
-        .filter(Notification.user_id == user_id)\
-        .order_by(Notification.created_at.desc())\
-        .offset(skip)\
+        .filter(Notification.user_id == user_id, Notification.id > after_id)\
+        .order_by(Notification.id)\
         .limit(limit)\
         .all()
 
@@ -52,12 +135,32 @@ def mark_notification_as_read(
         .first()
     
     if notification:
-        notification.is_read = True
+        # Conditional update so concurrent calls decrement the counter once
+        marked = db.execute(
+            update(Notification)
+            .where(Notification.id == notification.id, Notification.is_read == False)
+            .values(is_read=True)
+        ).rowcount
+        if marked:
+            remove_unread(db, user_id, "notifications")
         db.commit()
         db.refresh(notification)
     
     return notification
 
+def mark_all_notifications_as_read(
+    db: Session,
+    user_id: int
+) -> int:
+    marked = db.execute(
+        update(Notification)
+        .where(Notification.user_id == user_id, Notification.is_read == False)
+        .values(is_read=True)
+    ).rowcount
+    reset_unread(db, user_id, "notifications")
+    db.commit()
+    return marked
+
 def notify_course_created(
     db: Session,
     course: Course
@@ -95,42 +198,159 @@ def notify_material_added(
     course: Course,
     material
 ):
+    notifications = []
+    
     # Notify admin
     admin = db.query(User).filter(User.role == "admin").first()
     if admin:
-        create_notification(
-            db=db,
-            user_id=admin.id,
-            title="Nouveau matériel ajouté",
-            message=f"Un nouveau matériel a été ajouté au cours '{course.title}'",
-            type="material_added",
-            course_id=course.id,
-            material_id=material.id
-        )
+        notifications.append({
+            "user_id": admin.id,
+            "title": "Nouveau matériel ajouté",
+            "message": f"Un nouveau matériel a été ajouté au cours '{course.title}'",
+            "type": "material_added",
+            "course_id": course.id,
+            "material_id": material.id
+        })
     
     # Notify enrolled students
-    for progress in course.progress_records:
-        create_notification(
-            db=db,
-            user_id=progress.user_id,
-            title="Nouveau matériel disponible",
-            message=f"Un nouveau matériel est disponible dans le cours '{course.title}'",
-            type="material_added",
-            course_id=course.id,
-            material_id=material.id
-        )
+    student_ids = db.query(CourseProgress.user_id)\
+        .filter(CourseProgress.course_id == course.id)\
+        .all()
+    notifications.extend(
+        {
+            "user_id": user_id,
+            "title": "Nouveau matériel disponible",
+            "message": f"Un nouveau matériel est disponible dans le cours '{course.title}'",
+            "type": "material_added",
+            "course_id": course.id,
+            "material_id": material.id
+        }
+        for user_id, in student_ids
+    )
+    
+    create_notifications(db, notifications)
 
-def notify_course_progress(
+def notify_progress_updates(
     db: Session,
-    user_id: int,
-    course: Course,
-    progress: float
+    updates: List[List]
 ):
-    create_notification(
-        db=db,
-        user_id=user_id,
-        title="Progression mise à jour",
-        message=f"Votre progression dans le cours '{course.title}' est maintenant de {progress}%",
-        type="progress_updated",
-        course_id=course.id
-    ) 
\ No newline at end of file
+    """Notify [user_id, course_id, milestone] updates.
+
+    Each learner has a single progress notification per course. It is
+    replaced, unread, by each update instead of adding a row per update;
+    the new row gets a new id, so the live stream (which follows ids) sends
+    it. The same milestone is not notified twice within the debounce window.
+    """
+    # The highest milestone per course, one row per statement
+    milestones = {}
+    for user_id, course_id, milestone in updates:
+        if not _debounced("progress_updated", user_id, course_id, milestone):
+            key = (user_id, course_id)
+            milestones[key] = max(milestone, milestones.get(key, milestone))
+    if not milestones:
+        return
+    course_ids = {course_id for _, course_id in milestones}
+    titles = dict(db.query(Course.id, Course.title).filter(Course.id.in_(course_ids)).all())
+    updates = [
+        (user_id, course_id, milestone)
+        for (user_id, course_id), milestone in milestones.items()
+        if course_id in titles
+    ]
+    now = datetime.utcnow()
+    unread = Counter()
+    for start in range(0, len(updates), NOTIFICATION_BATCH_SIZE):
+        batch = updates[start:start + NOTIFICATION_BATCH_SIZE]
+        keys = [(user_id, course_id) for user_id, course_id, _ in batch]
+        # The current rows leave the unique index, and are deleted once the
+        # new ones are inserted: deleting them first would let SQLite reuse
+        # the highest id for a new row
+        replaced = db.execute(
+            update(Notification)
+            .where(
+                Notification.type == "progress_updated",
+                tuple_(Notification.user_id, Notification.related_course_id).in_(keys)
+            )
+            .values(type="progress_replaced")
+            .returning(Notification.id, Notification.user_id, Notification.related_course_id, Notification.is_read)
+            .execution_options(synchronize_session=False)
+        ).all()
+        # Rows that are new or were read add to the unread counters
+        was_unread = {(user_id, course_id) for _, user_id, course_id, is_read in replaced if not is_read}
+        unread.update(user_id for user_id, course_id in keys if (user_id, course_id) not in was_unread)
+        statement = upsert(db, Notification).values([
+            {
+                "user_id": user_id,
+                "title": "Progression mise à jour",
+                "message": f"Votre progression dans le cours '{titles[course_id]}' est maintenant de {milestone}%",
+                "type": "progress_updated",
+                "is_read": False,
+                "created_at": now,
+                "related_course_id": course_id
+            }
+            for user_id, course_id, milestone in batch
+        ])
+        # Rows inserted meanwhile by a concurrent update are taken over
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[Notification.user_id, Notification.related_course_id],
+            index_where=Notification.type == "progress_updated",
+            set_={
+                "message": statement.excluded.message,
+                "is_read": False,
+                "created_at": statement.excluded.created_at
+            }
+        ))
+        if replaced:
+            db.execute(
+                delete(Notification)
+                .where(Notification.id.in_([id for id, _, _, _ in replaced]))
+                .execution_options(synchronize_session=False)
+            )
+    add_unread(db, unread, "notifications")
+    for user_id in {user_id for user_id, _, _ in updates}:
+        publish(db, user_id, "notification")
+    db.commit()
+    for user_id, course_id, milestone in updates:
+        _mark_sent("progress_updated", user_id, course_id, milestone)
+
+# Background jobs, enqueued by the handlers with jobs.enqueue
+
+@job("notify_course_created")
+def notify_course_created_job(db: Session, course_id: int):
+    course = db.query(Course).filter(Course.id == course_id).first()
+    if course:
+        notify_course_created(db, course)
+
+@job("notify_course_deleted")
+def notify_course_deleted_job(db: Session, course_id: int, title: str):
+    # The course row is already gone when the job runs
+    notify_course_deleted(db, Course(id=course_id, title=title))
+
+@job("notify_material_added")
+def notify_material_added_job(db: Session, course_id: int, material_id: int):
+    course = db.query(Course).filter(Course.id == course_id).first()
+    material = db.query(CourseMaterial).filter(CourseMaterial.id == material_id).first()
+    if course and material:
+        notify_material_added(db, course, material)
+
+@job("notify_course_progress")
+def notify_course_progress_job(db: Session, user_id: int, course_id: int, progress: float):
+    # Queued by earlier versions on every update, with the raw progress:
+    # only the milestone it reached is notified
+    milestone = progress_milestone(None, progress)
+    if milestone:
+        notify_progress_updates(db, [[user_id, course_id, milestone]])
+
+@job("notify_progress_updates")
+def notify_progress_updates_job(db: Session, updates: List[List]):
+    notify_progress_updates(db, updates)
+
+# Async versions for handlers using an AsyncSession. They run the functions
+# above through run_sync, so lazy loads happen without blocking the loop.
+
+async def get_notifications_since_async(
+    db: AsyncSession,
+    user_id: int,
+    after_id: int,
+    limit: int = 100
+) -> List[Notification]:
+    return await db.run_sync(get_notifications_since, user_id, after_id, limit)
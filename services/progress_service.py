@@ -0,0 +1,114 @@
+from datetime import datetime
+from sqlalchemy import DateTime, Float, and_, bindparam, case, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.course import CourseProgress
+from jobs import enqueue
+from services.notification_service import progress_milestone
+from typing import Dict, Iterable, List, Set, Tuple
+
+progress_table = CourseProgress.__table__
+
+# (user_id, course_id) pairs per query, kept under SQLite's bound-parameter limit
+PROGRESS_BATCH_SIZE = 500
+
+def get_enrolled_course_ids(
+    db: Session,
+    user_id: int,
+    course_ids: Iterable[int]
+) -> Set[int]:
+    """The given courses the user is enrolled in, in one query."""
+    return set(db.scalars(
+        select(CourseProgress.course_id).where(
+            CourseProgress.user_id == user_id,
+            CourseProgress.course_id.in_(set(course_ids))
+        )
+    ))
+
+def _supersedes(current: Tuple, value: float, reported_at: datetime) -> bool:
+    progress, last_accessed, is_completed = current
+    if last_accessed is not None and last_accessed > reported_at:
+        # Written since, e.g. by PUT /courses/{id}/progress
+        return False
+    return not is_completed or value >= (progress or 0)
+
+def save_progress(
+    db: Session,
+    updates: Dict[Tuple[int, int], Tuple[float, datetime]]
+) -> int:
+    """Write (progress, reported_at) values keyed by (user_id, course_id).
+
+    One UPDATE statement executed for every row, in the caller's
+    transaction. A value is skipped if the row was written after it was
+    reported, and never lowers the progress of a completed course; the
+    statement checks both again, for writes made meanwhile. Rows reaching
+    100% are marked completed, as in update_course_progress. The previous
+    values are read first, to notify the milestones reached. Returns the
+    number of values written. The caller commits.
+    """
+    keys = list(updates)
+    current = {}
+    for start in range(0, len(keys), PROGRESS_BATCH_SIZE):
+        current.update(
+            ((user_id, course_id), (value, last_accessed, is_completed))
+            for user_id, course_id, value, last_accessed, is_completed in db.execute(
+                select(
+                    CourseProgress.user_id,
+                    CourseProgress.course_id,
+                    CourseProgress.progress,
+                    CourseProgress.last_accessed,
+                    CourseProgress.is_completed
+                )
+                .where(tuple_(CourseProgress.user_id, CourseProgress.course_id).in_(
+                    keys[start:start + PROGRESS_BATCH_SIZE]
+                ))
+            )
+        )
+    updates = {
+        key: (value, reported_at)
+        for key, (value, reported_at) in updates.items()
+        if key in current and _supersedes(current[key], value, reported_at)
+    }
+    if not updates:
+        return 0
+
+    progress = bindparam("b_progress", type_=Float)
+    reported_at = bindparam("b_reported_at", type_=DateTime)
+    newly_completed = and_(progress >= 100, progress_table.c.is_completed.is_not(True))
+    # A Table target: the ORM would only accept primary keys here
+    statement = (
+        update(progress_table)
+        .where(
+            progress_table.c.user_id == bindparam("b_user_id"),
+            progress_table.c.course_id == bindparam("b_course_id"),
+            or_(progress_table.c.last_accessed.is_(None), progress_table.c.last_accessed <= reported_at),
+            or_(progress_table.c.is_completed.is_not(True), progress_table.c.progress <= progress)
+        )
+        .values(
+            progress=progress,
+            last_accessed=reported_at,
+            is_completed=case((newly_completed, True), else_=progress_table.c.is_completed),
+            status=case((newly_completed, "Terminé"), else_=progress_table.c.status),
+            completion_date=case((newly_completed, reported_at), else_=progress_table.c.completion_date)
+        )
+    )
+    db.execute(statement, [
+        {"b_user_id": user_id, "b_course_id": course_id, "b_progress": value, "b_reported_at": at}
+        for (user_id, course_id), (value, at) in updates.items()
+    ])
+    # Learners are notified of the milestones they reached, in the background
+    milestones = [
+        [user_id, course_id, milestone]
+        for (user_id, course_id), (value, _) in updates.items()
+        if (milestone := progress_milestone(current[(user_id, course_id)][0], value))
+    ]
+    if milestones:
+        enqueue(db, "notify_progress_updates", updates=milestones)
+    return len(updates)
+
+async def get_enrolled_course_ids_async(
+    db: AsyncSession,
+    user_id: int,
+    course_ids: List[int]
+) -> Set[int]:
+    return await db.run_sync(get_enrolled_course_ids, user_id, course_ids)
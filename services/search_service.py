@@ -0,0 +1,128 @@
+import re
+from sqlalchemy import false, func, literal, literal_column, null, or_, select, text, true, union_all
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.course import Course, CourseMaterial
+from models.message import Message
+from models.user import User
+from search import COURSE, MATERIAL, MESSAGE, index_available, search_index
+from typing import List, Optional
+
+SEARCH_TYPES = ("course", "material", "message")
+
+def _terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query)
+
+def _match_expression(terms: List[str]) -> str:
+    # Quoted terms, all required; the last one also matches as a prefix
+    return " ".join(f'"{term}"' for term in terms) + "*"
+
+def _course_visibility(user: User):
+    # Same rules as course_service.get_course
+    if user.role == "admin":
+        return true()
+    elif user.role == "prof":
+        return (Course.instructor_id == user.id) | (Course.departement == user.departement)
+    elif user.role == "employer":
+        return Course.departement == user.departement
+    return false()
+
+def _message_visibility(user: User):
+    return (Message.sender_id == user.id) | (Message.receiver_id == user.id)
+
+def _fts_selects(terms: List[str], user: User):
+    hits = select(
+        search_index.c.rowid,
+        literal_column("bm25(search_index, 10.0, 1.0)").label("rank"),
+        literal_column("snippet(search_index, -1, '', '', '…', 12)").label("snippet")
+    ).where(text("search_index MATCH :match")).subquery()
+
+    def hit(model, kind):
+        # rowid = id * 4 + kind
+        return model.id == (hits.c.rowid - kind) // 4
+
+    courses = select(
+        literal("course").label("type"), Course.id, Course.title,
+        Course.id.label("course_id"), hits.c.snippet, hits.c.rank
+    ).join_from(hits, Course, hit(Course, COURSE))\
+        .where(hits.c.rowid % 4 == COURSE, _course_visibility(user))
+    materials = select(
+        literal("material").label("type"), CourseMaterial.id, CourseMaterial.file_name.label("title"),
+        CourseMaterial.course_id, hits.c.snippet, hits.c.rank
+    ).join_from(hits, CourseMaterial, hit(CourseMaterial, MATERIAL))\
+        .join(Course, Course.id == CourseMaterial.course_id)\
+        .where(hits.c.rowid % 4 == MATERIAL, _course_visibility(user))
+    messages = select(
+        literal("message").label("type"), Message.id, null().label("title"),
+        null().label("course_id"), hits.c.snippet, hits.c.rank
+    ).join_from(hits, Message, hit(Message, MESSAGE))\
+        .where(hits.c.rowid % 4 == MESSAGE, _message_visibility(user))
+    return {"course": courses, "material": materials, "message": messages}, {"match": _match_expression(terms)}
+
+def _like_selects(terms: List[str], user: User):
+    # Unranked fallback for databases without the FTS index
+    def matches(*columns):
+        return [or_(*(column.ilike(f"%{term}%") for column in columns)) for term in terms]
+
+    courses = select(
+        literal("course").label("type"), Course.id, Course.title, Course.id.label("course_id"),
+        func.substr(Course.description, 1, 120).label("snippet"), literal(0.0).label("rank")
+    ).where(_course_visibility(user), *matches(Course.title, Course.description))
+    materials = select(
+        literal("material").label("type"), CourseMaterial.id, CourseMaterial.file_name.label("title"),
+        CourseMaterial.course_id, literal("").label("snippet"), literal(0.0).label("rank")
+    ).join(Course, Course.id == CourseMaterial.course_id)\
+        .where(_course_visibility(user), *matches(CourseMaterial.file_name))
+    messages = select(
+        literal("message").label("type"), Message.id, null().label("title"), null().label("course_id"),
+        func.substr(Message.content, 1, 120).label("snippet"), literal(0.0).label("rank")
+    ).where(_message_visibility(user), *matches(Message.content))
+    return {"course": courses, "material": materials, "message": messages}, {}
+
+def search(
+    db: Session,
+    user: User,
+    query: str,
+    types: Optional[List[str]] = None,
+    skip: int = 0,
+    limit: int = 20
+) -> List[dict]:
+    """Best matches first among the courses, materials and messages the user can see."""
+    terms = _terms(query)
+    if not terms:
+        return []
+    
+    if index_available(db.connection()):
+        selects, params = _fts_selects(terms, user)
+    else:
+        selects, params = _like_selects(terms, user)
+    
+    results = union_all(*(selects[type] for type in (types or SEARCH_TYPES))).subquery()
+    rows = db.execute(
+        select(results)
+        .order_by(results.c.rank, results.c.type, results.c.id.desc())
+        .offset(skip)
+        .limit(limit),
+        params
+    ).mappings()
+    return [
+        {
+            "type": row["type"],
+            "id": row["id"],
+            "title": row["title"],
+            "course_id": row["course_id"],
+            "snippet": row["snippet"],
+            "score": -row["rank"]
+        }
+        for row in rows
+    ]
+
+async def search_async(
+    db: AsyncSession,
+    user: User,
+    query: str,
+    types: Optional[List[str]] = None,
+    skip: int = 0,
+    limit: int = 20
+) -> List[dict]:
+    return await db.run_sync(search, user, query, types, skip, limit)
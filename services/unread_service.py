@@ -0,0 +1,68 @@
+from sqlalchemy import case, update
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from models.unread_counter import UnreadCounter
+from database import upsert
+from typing import Dict
+
+# Rows per multi-row upsert, kept under SQLite's bound-parameter limit
+UNREAD_BATCH_SIZE = 500
+
+# The counters are updated in the caller's transaction; callers commit.
+
+def add_unread(
+    db: Session,
+    counts: Dict[int, int],
+    field: str
+):
+    """Add counts[user_id] to the given counter ("notifications" or "messages")."""
+    column = getattr(UnreadCounter, field)
+    rows = [
+        {"user_id": user_id, "notifications": 0, "messages": 0, field: count}
+        for user_id, count in counts.items()
+    ]
+    for start in range(0, len(rows), UNREAD_BATCH_SIZE):
+        statement = upsert(db, UnreadCounter).values(rows[start:start + UNREAD_BATCH_SIZE])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[UnreadCounter.user_id],
+            set_={field: column + getattr(statement.excluded, field)}
+        ))
+
+def remove_unread(
+    db: Session,
+    user_id: int,
+    field: str,
+    count: int = 1
+):
+    column = getattr(UnreadCounter, field)
+    db.execute(
+        update(UnreadCounter)
+        .where(UnreadCounter.user_id == user_id)
+        .values({field: case((column > count, column - count), else_=0)})
+    )
+
+def reset_unread(
+    db: Session,
+    user_id: int,
+    field: str
+):
+    db.execute(
+        update(UnreadCounter)
+        .where(UnreadCounter.user_id == user_id)
+        .values({field: 0})
+    )
+
+def get_unread_counts(
+    db: Session,
+    user_id: int
+) -> Dict[str, int]:
+    counter = db.get(UnreadCounter, user_id)
+    if counter is None:
+        return {"notifications": 0, "messages": 0}
+    return {"notifications": counter.notifications, "messages": counter.messages}
+
+async def get_unread_counts_async(
+    db: AsyncSession,
+    user_id: int
+) -> Dict[str, int]:
+    return await db.run_sync(get_unread_counts, user_id)
@@ -0,0 +1,137 @@
+import csv
+import io
+import json
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+from pydantic import ValidationError
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+from models.user import User
+from auth import get_password_hash, hash_pool, invalidate_users
+from database import upsert
+from schemas import UserImport
+
+# Users hashed and inserted per statement and commit, kept under
+# SQLite's bound-parameter limit
+IMPORT_BATCH_SIZE = 500
+
+def read_user_rows(file: BinaryIO, filename: str) -> Iterator[Tuple[int, Optional[dict]]]:
+    """(line number, fields) for each record of a CSV or JSON Lines file.
+
+    The file is read one line at a time. CSV files need a header row.
+    Records that cannot be parsed are yielded as None.
+    """
+    text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+    if filename.lower().endswith((".jsonl", ".ndjson")):
+        for line_number, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_number, record if isinstance(record, dict) else None
+    else:
+        reader = csv.DictReader(text)
+        for record in reader:
+            # Empty cells count as missing
+            yield reader.line_num, {key: value for key, value in record.items() if key and value}
+
+def _validation_message(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(map(str, detail['loc']))}: {detail['msg']}" for detail in error.errors()
+    )
+
+def _import_batch(
+    db: Session,
+    batch: List[UserImport],
+    approve: bool,
+    seen: set,
+    result: dict
+):
+    # One query for the whole batch
+    emails = [user.email for user in batch]
+    existing = set(db.scalars(select(User.email).where(User.email.in_(emails))))
+    new_users = []
+    for user in batch:
+        if user.email in existing or user.email in seen:
+            result["duplicates"].append(user.email)
+        else:
+            seen.add(user.email)
+            new_users.append(user)
+    if not new_users:
+        return
+
+    hashed_passwords = hash_pool.map(get_password_hash, [user.password for user in new_users])
+    rows = [
+        dict(
+            nom=user.nom,
+            prenom=user.prenom,
+            departement=user.departement,
+            role=user.role,
+            email=user.email,
+            telephone=user.telephone,
+            hashed_password=hashed_password,
+            is_active=True,
+            is_approved=approve,
+        )
+        for user, hashed_password in zip(new_users, hashed_passwords)
+    ]
+    # Emails registered meanwhile are skipped, not an error
+    inserted = set(db.scalars(
+        upsert(db, User).values(rows)
+        .on_conflict_do_nothing(index_elements=[User.email])
+        .returning(User.email)
+    ))
+    db.commit()
+    result["created"] += len(inserted)
+    result["duplicates"].extend(row["email"] for row in rows if row["email"] not in inserted)
+
+def import_users(
+    db: Session,
+    records: Iterable[Tuple[int, Optional[dict]]],
+    approve: bool = True
+) -> dict:
+    """Create users from (line number, fields) records, in batches.
+
+    Each batch is committed on its own. Invalid records and emails that are
+    already registered (or repeated in the file) are reported and skipped.
+    """
+    result = {"created": 0, "duplicates": [], "errors": []}
+    seen = set()
+    batch = []
+    for line, record in records:
+        if record is None:
+            result["errors"].append({"line": line, "error": "Invalid record"})
+            continue
+        try:
+            batch.append(UserImport.model_validate(record))
+        except ValidationError as e:
+            result["errors"].append({"line": line, "error": _validation_message(e)})
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            _import_batch(db, batch, approve, seen, result)
+            batch = []
+    if batch:
+        _import_batch(db, batch, approve, seen, result)
+    return result
+
+def set_approval(
+    db: Session,
+    user_ids: List[int],
+    is_approved: bool
+) -> List[int]:
+    """Approve or reject users in one statement. Returns the ids changed.
+
+    The caller commits.
+    """
+    changed = db.execute(
+        update(User)
+        .where(User.id.in_(user_ids), User.is_approved.is_not(is_approved))
+        .values(is_approved=is_approved)
+        .returning(User.id, User.email)
+        .execution_options(synchronize_session=False)
+    ).all()
+    # Cached principals carry the approval. Tokens are only revoked on
+    # rejection: pending users cannot obtain any.
+    invalidate_users(db, changed, revoke_tokens=not is_approved)
+    return [user_id for user_id, email in changed]
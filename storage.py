@@ -0,0 +1,115 @@
+import os
+import logging
+from typing import Iterable
+
+from sqlalchemy import delete, event, inspect, update
+from sqlalchemy.orm import Session
+
+from database import SessionLocal, upsert
+from models.blob import Blob
+from models.blob_text import BlobText
+from models.course import CourseMaterial
+from models.message import Message
+from utils import UPLOAD_DIR, StoredUpload
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed store: uploads/blobs/<first two hex digits>/<sha256>
+BLOB_DIR = os.path.join(UPLOAD_DIR, "blobs")
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+def store_blob(db: Session, upload: StoredUpload) -> Blob:
+    """Store a streamed upload, reusing the existing blob for identical content.
+
+    Takes a reference on the blob, in the caller's transaction: the caller
+    sets blob_sha256 on one CourseMaterial or Message. References are
+    released by the events below.
+    """
+    # Counted in the same statement that creates the row, so garbage
+    # collection cannot delete the blob before the referencing row exists.
+    # Another request may store the same content concurrently.
+    statement = upsert(db, Blob).values(
+        sha256=upload.sha256,
+        path=blob_path(upload.sha256),
+        size=upload.size,
+        ref_count=1
+    )
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[Blob.sha256],
+        set_={"ref_count": Blob.ref_count + 1}
+    ))
+    blob = db.get(Blob, upload.sha256)
+
+    # A collected blob's file is deleted before its row: it is written again
+    if os.path.exists(blob.path):
+        upload.discard()
+    else:
+        os.makedirs(os.path.dirname(blob.path), exist_ok=True)
+        os.replace(upload.temp_path, blob.path)
+    return blob
+
+def collect_garbage(shas: Iterable[str]) -> int:
+    """Delete blobs that are no longer referenced, with their files."""
+    removed = 0
+    db = SessionLocal()
+    try:
+        for sha256 in shas:
+            blob = db.get(Blob, sha256)
+            if blob is None:
+                continue
+            path = blob.path
+            # Conditional delete: a concurrent upload may reference it again
+            result = db.execute(
+                delete(Blob).where(Blob.sha256 == sha256, Blob.ref_count <= 0)
+            )
+            if result.rowcount == 1:
+                db.execute(delete(BlobText).where(BlobText.sha256 == sha256))
+                if os.path.exists(path):
+                    os.remove(path)
+                removed += 1
+        db.commit()
+    finally:
+        db.close()
+    return removed
+
+# References are taken by store_blob and released in the same flush as the
+# rows that held them
+
+def _change_ref_count(connection, session, sha256: str, delta: int):
+    connection.execute(
+        update(Blob)
+        .where(Blob.sha256 == sha256)
+        .values(ref_count=Blob.ref_count + delta)
+    )
+    if delta < 0:
+        session.info.setdefault("released_blobs", set()).add(sha256)
+
+def _blob_ref_updated(mapper, connection, target):
+    session = Session.object_session(target)
+    for sha256 in inspect(target).attrs.blob_sha256.history.deleted:
+        if sha256:
+            _change_ref_count(connection, session, sha256, -1)
+
+def _blob_ref_deleted(mapper, connection, target):
+    if target.blob_sha256:
+        _change_ref_count(connection, Session.object_session(target), target.blob_sha256, -1)
+
+for model in (CourseMaterial, Message):
+    event.listen(model, "after_update", _blob_ref_updated)
+    event.listen(model, "after_delete", _blob_ref_deleted)
+
+@event.listens_for(Session, "after_commit")
+def _collect_released_blobs(session):
+    shas = session.info.pop("released_blobs", None)
+    if shas:
+        try:
+            collect_garbage(shas)
+        except Exception:
+            # Leftover blobs are picked up by the next dedup_uploads run
+            logger.exception("Failed to collect unreferenced blobs")
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_released_blobs(session, previous_transaction):
+    session.info.pop("released_blobs", None)
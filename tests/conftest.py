@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# The engines are created when database is imported: point them at a
+# throwaway database before any application module is loaded
+_data_dir = tempfile.mkdtemp(prefix="rbit-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_data_dir}/test.db"
+os.environ.pop("ASYNC_DATABASE_URL", None)
+os.environ.pop("REPLICA_DATABASE_URL", None)
+os.environ.setdefault("SECRET_KEY", "test-secret-key")
+os.environ["JOB_QUEUE_ENABLED"] = "false"
+os.chdir(_data_dir)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,91 @@
+"""The dashboards run a fixed number of statements, however many courses exist."""
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+import main
+from auth import get_password_hash
+from database import SessionLocal, engine
+from models import Base, User
+from models.course import Course, CourseMaterial
+
+@pytest.fixture(scope="module")
+def client():
+    Base.metadata.create_all(bind=engine)
+    return TestClient(main.app)
+
+def create_user(email: str, role: str) -> int:
+    db = SessionLocal()
+    try:
+        user = User(
+            nom="Nom", prenom="Prenom", departement="info", role=role, email=email,
+            telephone="0", hashed_password=get_password_hash("password"),
+            is_active=True, is_approved=True
+        )
+        db.add(user)
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+def create_courses(instructor_id: int, count: int, materials: int = 2):
+    db = SessionLocal()
+    try:
+        for i in range(count):
+            course = Course(title=f"Course {i}", description="", instructor_id=instructor_id)
+            course.materials = [
+                CourseMaterial(file_name=f"m{j}.pdf", file_path=f"m{j}.pdf", file_type="application/pdf")
+                for j in range(materials)
+            ]
+            db.add(course)
+        db.commit()
+    finally:
+        db.close()
+
+def login(client: TestClient, email: str) -> dict:
+    response = client.post("/token", data={"username": email, "password": "password"})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+def count_statements(client: TestClient, path: str, headers: dict) -> int:
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    # Engine-wide, so the async engine's statements are counted too
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        response = client.get(path, headers=headers)
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code == 200, response.text
+    return len(statements)
+
+@pytest.mark.parametrize("role,path,key", [
+    ("prof", "/dashboard/prof", "courses"),
+    ("employer", "/dashboard/employer", "available_courses"),
+])
+def test_dashboard_statement_count_does_not_grow_with_courses(client, role, path, key):
+    prof_email = f"prof-{role}@example.com"
+    prof_id = create_user(prof_email, "prof")
+    if role == "prof":
+        email = prof_email
+    else:
+        email = f"{role}@example.com"
+        create_user(email, role)
+    headers = login(client, email)
+
+    create_courses(prof_id, 1)
+    # Warm up: the user is cached after the first authenticated request
+    client.get(path, headers=headers)
+    with_one_course = count_statements(client, path, headers)
+
+    create_courses(prof_id, 20)
+    with_many_courses = count_statements(client, path, headers)
+
+    courses = client.get(path, headers=headers).json()[key]
+    assert len(courses) >= 21
+    assert with_many_courses == with_one_course
+    assert with_one_course <= 3
@@ -1,30 +1,73 @@
 import os
-import shutil
-from fastapi import UploadFile
-from datetime import datetime
+import hashlib
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+import anyio
+from fastapi import HTTPException, UploadFile, status
 
 UPLOAD_DIR = "uploads"
+# Uploads are streamed here first, then renamed into place
+UPLOAD_TMP_DIR = os.path.join(UPLOAD_DIR, "tmp")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+MB = 1024 * 1024
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(20 * MB)))
+UPLOAD_MAX_SIZE_BY_ROLE = {
+    "admin": int(os.getenv("UPLOAD_MAX_SIZE_ADMIN", str(200 * MB))),
+    "prof": int(os.getenv("UPLOAD_MAX_SIZE_PROF", str(200 * MB))),
+    "employer": int(os.getenv("UPLOAD_MAX_SIZE_EMPLOYER", str(UPLOAD_MAX_SIZE))),
+}
+
+@dataclass
+class StoredUpload:
+    """An upload streamed to a temporary file, waiting to be moved into place."""
+    temp_path: str
+    filename: str
+    content_type: Optional[str]
+    size: int
+    sha256: str
+
+    def discard(self):
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
 
 def ensure_upload_dir():
     if not os.path.exists(UPLOAD_DIR):
         os.makedirs(UPLOAD_DIR)
 
-def save_uploaded_file(file: UploadFile, course_id: int) -> str:
-    ensure_upload_dir()
-    
-    # Create course-specific directory
-    course_dir = os.path.join(UPLOAD_DIR, str(course_id))
-    if not os.path.exists(course_dir):
-        os.makedirs(course_dir)
-    
-    # Generate unique filename
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    file_extension = os.path.splitext(file.filename)[1]
-    unique_filename = f"{timestamp}_{file.filename}"
-    file_path = os.path.join(course_dir, unique_filename)
-    
-    # Save the file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    return file_path 
\ No newline at end of file
+def get_upload_size_limit(role: str) -> int:
+    return UPLOAD_MAX_SIZE_BY_ROLE.get(role, UPLOAD_MAX_SIZE)
+
+async def stream_upload(file: UploadFile, max_size: int = UPLOAD_MAX_SIZE) -> StoredUpload:
+    """Copy an upload to a temporary file in fixed-size chunks.
+
+    Memory use does not depend on the file size, the SHA-256 is computed on
+    the fly and the copy is aborted with a 413 as soon as max_size is exceeded.
+    """
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    temp_path = os.path.join(UPLOAD_TMP_DIR, f"{uuid.uuid4().hex}.part")
+    checksum = hashlib.sha256()
+    size = 0
+    try:
+        async with await anyio.open_file(temp_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(
+                        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                        detail=f"File exceeds the maximum size of {max_size} bytes"
+                    )
+                checksum.update(chunk)
+                await buffer.write(chunk)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return StoredUpload(
+        temp_path=temp_path,
+        filename=file.filename,
+        content_type=file.content_type,
+        size=size,
+        sha256=checksum.hexdigest()
+    )